@@ -86,9 +86,13 @@ DATABASES = {
     }
 }
 
+# Shared between import_replays and the web processes, so the import generation
+# the importer bumps is seen by every page. Tests can use
+# django.core.cache.backends.locmem.LocMemCache instead.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
    }
 }
 
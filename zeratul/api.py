@@ -0,0 +1,203 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+
+from zeratul.conditional import import_conditional
+from zeratul.models import Map, Game, GamePlayer, Player, PlayerStat
+from zeratul.stats import STAT_ITEMS
+from zeratul.views import _cursor
+
+
+# Rows read per query while streaming a collection. Each chunk seeks past the
+# last id of the one before, so a full export holds one chunk in memory.
+CHUNK_SIZE = 500
+
+GAME_FIELDS = ['id', 'started_at', 'length_in_seconds', 'type', 'region', 'expansion', 'version',
+    'num_teams', 'matchup', 'winning_race', 'map__name', 'map__slug']
+
+GAME_PLAYER_FIELDS = ['team__game_id', 'team__team_number', 'result', 'player__name', 'race', 'color',
+    'handicap', 'is_human', 'apm'] + STAT_ITEMS
+
+
+def _limit(value):
+    limit = _cursor(value)
+    return limit if limit and limit > 0 else None
+
+
+def _json(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def _not_found():
+    return JsonResponse({'error': 'Not found'}, status=404)
+
+
+def stream_collection(name, rows, limit, has_more):
+    '''
+    A response writing {"<name>": [...], "next": <id>} one row at a time as
+    rows is consumed. rows must yield dicts with an id, in id order. When
+    limit rows were written and has_more(last_id) says there are more, next
+    is the after cursor of the following page, otherwise null.
+    '''
+    def content():
+        yield '{"%s": [' % name
+        count = 0
+        last_id = None
+        for row in rows:
+            yield (',' if count else '') + _json(row)
+            count += 1
+            last_id = row['id']
+            if count == limit:
+                break
+        next = last_id if count == limit and has_more(last_id) else None
+        yield '], "next": %s}' % _json(next)
+
+    return StreamingHttpResponse(content(), content_type='application/json')
+
+
+def iter_chunks(queryset, after=None, chunk_size=CHUNK_SIZE, key='id'):
+    '''
+    Rows of a values() queryset in key order, fetched chunk_size at a time by
+    seeking on that unique, indexed column instead of one query over the
+    whole table. iterator() keeps Django from caching the rows of a chunk on
+    top of that.
+    '''
+    while True:
+        chunk = queryset.filter(**{key + '__gt': after or 0}).order_by(key)[:chunk_size]
+        count = 0
+        for row in chunk.iterator():
+            count += 1
+            after = row[key]
+            yield row
+        if count < chunk_size:
+            return
+
+
+def iter_game_rows(after=None, chunk_size=CHUNK_SIZE):
+    '''
+    Every game after the game id after, oldest id first, with its teams and
+    players nested. Two queries per chunk, neither builds model instances.
+    '''
+    games = Game.objects.values(*GAME_FIELDS)
+    chunk = []
+    for game in iter_chunks(games, after, chunk_size):
+        chunk.append(game)
+        if len(chunk) == chunk_size:
+            for game in _with_teams(chunk):
+                yield game
+            chunk = []
+    for game in _with_teams(chunk):
+        yield game
+
+
+def _with_teams(games):
+    if not games:
+        return []
+
+    teams = dict( (game['id'], {}) for game in games )
+    game_players = GamePlayer.objects.filter(team__game_id__in=list(teams)).values(*GAME_PLAYER_FIELDS).order_by('team__team_number', 'id')
+    for game_player in game_players:
+        team_number = game_player.pop('team__team_number')
+        game_teams = teams[game_player.pop('team__game_id')]
+        if team_number not in game_teams:
+            game_teams[team_number] = {'team_number': team_number, 'result': game_player['result'], 'players': []}
+        game_player['name'] = game_player.pop('player__name')
+        game_teams[team_number]['players'].append(game_player)
+
+    for game in games:
+        game['map'] = {'name': game.pop('map__name'), 'slug': game.pop('map__slug')}
+        game['teams'] = [team for number, team in sorted(teams[game['id']].items())]
+    return games
+
+
+#
+# Games
+#
+@import_conditional
+def games(request):
+    '''
+    Every game in id order, so ?after=<id> of the last game seen also picks
+    up games imported since. ?limit=<n> pages through them, next holds the
+    after cursor of the following page.
+    '''
+    after = _cursor(request.GET.get('after'))
+    limit = _limit(request.GET.get('limit'))
+    has_more = lambda last_id: Game.objects.filter(id__gt=last_id).exists()
+    return stream_collection('games', iter_game_rows(after, min(limit or CHUNK_SIZE, CHUNK_SIZE)), limit, has_more)
+
+
+@import_conditional
+def game_detail(request, id):
+    game = Game.objects.get_game_detail_for_id(id)
+    if game is None:
+        return _not_found()
+    return JsonResponse(game)
+
+
+#
+# Maps
+#
+@import_conditional
+def maps(request):
+    return JsonResponse({'maps': Map.objects.get_all()})
+
+
+@import_conditional
+def map_detail(request, slug):
+    map = Map.objects.get_all_map_details(slug)
+    if not map:
+        return _not_found()
+    return JsonResponse(map)
+
+
+#
+# Players
+#
+@import_conditional
+def players(request):
+    '''
+    Every player with their totals, in player id order, paged like games.
+    Player ids stay the same when rebuild_stats recreates the PlayerStat rows,
+    so saved cursors keep working.
+    '''
+    after = _cursor(request.GET.get('after'))
+    limit = _limit(request.GET.get('limit'))
+    stats = PlayerStat.objects.values('player_id', 'player__name', 'player__region', 'games', 'wins', 'losses', 'win_rate', 'apm_total', 'max_apm')
+    has_more = lambda last_id: PlayerStat.objects.filter(player_id__gt=last_id).exists()
+    rows = (_player_row(stat) for stat in iter_chunks(stats, after, min(limit or CHUNK_SIZE, CHUNK_SIZE), key='player_id'))
+    return stream_collection('players', rows, limit, has_more)
+
+
+def _player_row(stat):
+    stat['id'] = stat.pop('player_id')
+    stat['name'] = stat.pop('player__name')
+    stat['region'] = stat.pop('player__region')
+    stat['avg_apm'] = float(stat.pop('apm_total'))/stat['games'] if stat['games'] > 0 else 0.0
+    return stat
+
+
+@import_conditional
+def player_detail(request, name):
+    player = Player.objects.get_player_profile(name)
+    if player is None:
+        return _not_found()
+    return JsonResponse(player)
+
+
+#
+# Stats
+#
+@import_conditional
+def stats(request):
+    return JsonResponse({
+        'game_count': Game.objects.cached_count(),
+        'player_count': Player.objects.cached_count(),
+        'average_game_length': Game.objects.average_game_length(),
+        'total_gameplay_time': Game.objects.total_gameplay_time(),
+        'average_apm': Player.objects.average_apm(),
+        'average_of_best_apms': Player.objects.average_of_best_apms(),
+        'races': Game.objects.race_result_totals(),
+        'matchups': Game.objects.race_stats(),
+        'maps': Map.objects.get_matchup_matrix(),
+    })
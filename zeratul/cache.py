@@ -0,0 +1,116 @@
+import hashlib
+
+from functools import wraps
+from itertools import islice
+
+from django.core.cache import cache
+from django.utils import timezone
+
+
+# Every cached page or stat is keyed by the import generation, a counter
+# import_replays bumps when it finishes. Bumping it makes every older key
+# unreachable at once, the stale entries simply age out of the cache. The
+# importer and the web processes must share the cache (memcached) for this.
+GENERATION_KEY = 'zeratul:import_generation'
+
+# When the generation was last bumped, the validator of every page
+IMPORTED_AT_KEY = 'zeratul:imported_at'
+
+# Entries of old generations are never read again, this only bounds how long
+# they take up room
+IMPORT_CACHE_TIMEOUT = 7*24*60*60
+
+
+def import_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # add() so two processes starting at once agree on the first value
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY) or 1
+    return generation
+
+
+def bump_import_generation():
+    cache.set(IMPORTED_AT_KEY, timezone.now(), None)
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not in the cache (yet, or any more), start a new series
+        generation = import_generation() + 1
+        cache.set(GENERATION_KEY, generation, None)
+        return generation
+
+
+def import_key(name, *args):
+    '''
+    Cache key for name and args under the current import generation. The
+    args are hashed, so any repr-able values (player names included) give
+    a valid memcached key.
+    '''
+    digest = hashlib.md5(repr(args)).hexdigest()
+    return 'zeratul:%d:%s:%s' % (import_generation(), name, digest)
+
+
+def cached_by_import(name):
+    '''
+    Caches the result of a manager method until the next import. The key is
+    built from name and the method's arguments, which should be plain values
+    such as ids, slugs or names rather than model instances. None results
+    are not cached.
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = import_key(name, *(args + tuple(sorted(kwargs.items()))))
+            result = cache.get(key)
+            if result is None:
+                result = method(self, *args, **kwargs)
+                cache.set(key, result, IMPORT_CACHE_TIMEOUT)
+            return result
+        return wrapper
+    return decorator
+
+
+# A game's summary and rendered rows never change once it is imported, so
+# they are keyed by game id alone and kept across imports. The importer
+# forgets them when it deletes a game, as the id may be handed out again.
+GAME_CACHE_TIMEOUT = 30*24*60*60
+
+# Everything cached per game, 'row:' entries are the rendered row templates
+GAME_CACHE_KINDS = ['summary', 'row:games_row.html', 'row:map_detail_row.html']
+
+# Part of every per game key. Bump it when Game.summary_dict or one of the row
+# templates changes, so a deploy stops reading what the old code cached.
+GAME_CACHE_VERSION = 1
+
+
+def game_key(kind, game_id):
+    return 'zeratul:game:v%d:%s:%d' % (GAME_CACHE_VERSION, kind, game_id)
+
+
+def get_many_by_game(kind, ids, load):
+    '''
+    The cached values of kind for the games with ids, in the same order, from
+    a single get_many. load is called once with the ids that were not in the
+    cache and returns a dict of id to value, which is cached for next time.
+    Games load does not return are left out.
+    '''
+    keys = dict( (game_id, game_key(kind, game_id)) for game_id in ids )
+    found = cache.get_many(keys.values())
+
+    missing = [game_id for game_id in ids if keys[game_id] not in found]
+    if missing:
+        loaded = dict( (keys[game_id], value) for game_id, value in load(missing).items() )
+        cache.set_many(loaded, GAME_CACHE_TIMEOUT)
+        found.update(loaded)
+
+    return [found[keys[game_id]] for game_id in ids if keys[game_id] in found]
+
+
+def forget_games(ids):
+    ids = iter(ids)
+    while True:
+        chunk = list(islice(ids, 1000))
+        if not chunk:
+            return
+        cache.delete_many([game_key(kind, game_id) for game_id in chunk for kind in GAME_CACHE_KINDS])
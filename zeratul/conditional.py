@@ -0,0 +1,57 @@
+import hashlib
+
+from functools import wraps
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from zeratul.cache import IMPORTED_AT_KEY
+from zeratul.models import ReplayFile
+
+
+# How long browsers and nginx may reuse a page without asking again. After
+# that they revalidate and get a 304 until the next import, so this only
+# bounds how long a finished import can go unnoticed.
+PAGE_MAX_AGE = 60
+
+
+def last_import():
+    '''
+    When the data last changed, as recorded by bump_import_generation. If the
+    cache lost it, the newest manifest row is close enough.
+    '''
+    imported_at = cache.get(IMPORTED_AT_KEY)
+    if imported_at is None:
+        imported_at = ReplayFile.objects.aggregate(Max('imported_at'))['imported_at__max'] or timezone.now()
+        cache.add(IMPORTED_AT_KEY, imported_at, None)
+        imported_at = cache.get(IMPORTED_AT_KEY) or imported_at
+    return imported_at
+
+
+def _last_modified(request, *args, **kwargs):
+    return last_import()
+
+
+def _etag(request, *args, **kwargs):
+    # The path holds the game id, map slug or player name of detail pages and
+    # the query string the page and sort order of lists
+    return hashlib.md5('%s:%s' % (last_import().isoformat(), request.get_full_path())).hexdigest()
+
+
+def import_conditional(view):
+    '''
+    Answers conditional GETs for view with a 304, without running it, until
+    the next import. Responses carry an ETag and Last-Modified derived from
+    the last import, and may be cached publicly for PAGE_MAX_AGE seconds.
+    '''
+    conditional_view = condition(etag_func=_etag, last_modified_func=_last_modified)(view)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        patch_cache_control(response, public=True, max_age=PAGE_MAX_AGE)
+        return response
+    return wrapper
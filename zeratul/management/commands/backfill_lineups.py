@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from django.db import transaction
+
+from zeratul.cache import bump_import_generation, forget_games
+from zeratul.models import Game, GameTeam, GamePlayer
+
+
+class Command(BaseCommand):
+    help = 'Fill in the matchup, lineup and result columns for games imported before they existed'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size',
+            type=int,
+            default=500,
+            dest='chunk_size',
+            help='Number of games updated per transaction (default: 500)')
+
+
+    def execute(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size'] if 'chunk_size' in kwargs and kwargs['chunk_size'] else 500
+
+        # One UPDATE per distinct result copies the team result onto its players
+        for result in GameTeam.objects.values_list('result', flat=True).distinct():
+            GamePlayer.objects.filter(team__result=result).update(result=result)
+
+        # Games are walked in id order, one chunk at a time, instead of being
+        # loaded all at once
+        game_count = 0
+        last_id = 0
+        while True:
+            games = list( Game.objects.filter(id__gt=last_id).order_by('id').prefetch_related('teams__players')[:chunk_size] )
+            if not games:
+                break
+
+            with transaction.atomic():
+                for game in games:
+                    self.backfill_game(game)
+
+            # The game type in their cached summaries and rows has changed
+            forget_games([game.id for game in games])
+
+            game_count += len(games)
+            last_id = games[-1].id
+            print 'Backfilled %d games' % game_count
+
+        # Pages and stats cached from the old lineup columns are no longer read
+        bump_import_generation()
+
+
+    def backfill_game(self, game):
+        lineup = []
+        for team in sorted(game.teams.all(), key=lambda team: team.team_number):
+            game_players = sorted(team.players.all(), key=lambda game_player: game_player.id)
+            lineup.append( (team.result, game_players) )
+
+        game.set_lineup(lineup)
+        game.save(update_fields=['num_teams', 'is_one_v_one', 'lineup', 'matchup', 'winning_race', 'winner'])
+
+        GamePlayer.objects.filter(team__game=game).update(game=game)
@@ -0,0 +1,204 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+import re
+
+from zeratul import api, views
+from zeratul.models import Game, PlayerStat
+from zeratul.summaries import SummaryUpdater
+
+
+# Tables that grow with every imported replay and must never be scanned whole
+LARGE_TABLES = ['zeratul_game', 'zeratul_gameteam', 'zeratul_gameplayer', 'zeratul_playerstat']
+
+# Every call runs against the database, none is answered from the cache
+NO_CACHE = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
+
+
+class CaptureStatements(CaptureQueriesContext):
+    '''
+    CaptureQueriesContext that also keeps the SQL and params of every
+    statement as they were sent. The captured SQL of some backends, SQLite's
+    among them, is only a repr of the two and cannot be run again.
+    '''
+
+    def __enter__(self):
+        self.statements = []
+        ops = self.connection.ops
+        last_executed_query = ops.last_executed_query
+
+        def record(cursor, sql, params):
+            self.statements.append( (sql, params) )
+            return last_executed_query(cursor, sql, params)
+
+        ops.last_executed_query = record
+        return super(CaptureStatements, self).__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Back to the method of the class
+        del self.connection.ops.last_executed_query
+        super(CaptureStatements, self).__exit__(exc_type, exc_value, traceback)
+
+
+class Command(BaseCommand):
+    help = 'Run the pages, API and import paths, EXPLAIN every query they send and fail if one scans a large table sequentially'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans',
+            action='store_true',
+            default=False,
+            dest='verbose_plans',
+            help='Print the full plan of every query')
+
+
+    def execute(self, *args, **kwargs):
+        verbose = 'verbose_plans' in kwargs and kwargs['verbose_plans']
+
+        results = self.check_plans()
+        failures = []
+        for name, sql, plan, scanned in results:
+            if scanned is None:
+                status = 'whole table, cached per import'
+            elif scanned:
+                status = 'SEQ SCAN on %s' % ', '.join(scanned)
+                failures.append(name)
+            else:
+                status = 'ok'
+
+            table = re.search(r'\bFROM "?(\w+)', sql)
+            print '%-40s %-20s %s' % (name, table.group(1) if table else '', status)
+            if verbose or scanned:
+                print '    ' + sql
+                print '    ' + plan.replace('\n', '\n    ')
+
+        if failures:
+            raise CommandError('%d queries scan a large table sequentially: %s' % (len(failures), ', '.join(sorted(set(failures)))))
+
+
+    def check_plans(self):
+        '''
+        Runs every call from get_calls, then EXPLAINs each distinct SELECT
+        it sent. Returns (call name, sql, plan, scanned tables) for each of
+        them. Scanned is None for statements that read a whole table by
+        design, aggregates without a WHERE or LIMIT that are only run once
+        per import.
+        '''
+        if connection.vendor == 'postgresql':
+            explain = self.explain_postgresql
+        elif connection.vendor == 'sqlite':
+            explain = self.explain_sqlite
+        else:
+            raise CommandError('Query plans can only be checked on Postgres or SQLite')
+
+        statements = []
+        seen = set()
+        with override_settings(CACHES=NO_CACHE):
+            for name, call in self.get_calls():
+                with CaptureStatements(connection) as captured:
+                    call()
+                for sql, params in captured.statements:
+                    if sql.lstrip().upper().startswith('SELECT') and sql not in seen:
+                        seen.add(sql)
+                        statements.append( (name, sql, params) )
+
+        results = []
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # On a small or freshly seeded table a sequential scan is the
+                # cheapest plan anyway; with them priced out, any Seq Scan left
+                # means there is no index the query could use
+                connection.cursor().execute('SET LOCAL enable_seqscan = off')
+
+            for name, sql, params in statements:
+                plan = explain(sql, params)
+                if self.is_whole_table(sql):
+                    scanned = None
+                else:
+                    scanned = [table for table in LARGE_TABLES if self.is_scanned(plan, table)]
+                results.append( (name, sql, plan, scanned) )
+
+        return results
+
+
+    def get_calls(self):
+        '''
+        The views, API endpoints and import paths whose queries are checked,
+        run against rows that exist so every branch sends its queries.
+        '''
+        game = Game.objects.select_related('map').order_by('id').first()
+        stat = PlayerStat.objects.select_related('player').order_by('id').first()
+        if game is None or stat is None:
+            raise CommandError('There are no games to run the queries against, import some replays first')
+
+        factory = RequestFactory()
+
+        def page(view, path, data={}, **kwargs):
+            def call():
+                response = view(factory.get(path, data), **kwargs)
+                if response.streaming:
+                    ''.join(response.streaming_content)
+            return call
+
+        calls = [
+            ('home', page(views.home, '/')),
+            ('games page', page(views.games, '/games/')),
+            ('games page after cursor', page(views.games, '/games/', {'after': game.id})),
+            ('games page before cursor', page(views.games, '/games/', {'before': game.id})),
+            ('games page by number', page(views.games, '/games/', {'page': 2})),
+            ('game detail', page(views.game_detail, '/game/', id=str(game.id))),
+            ('maps', page(views.maps, '/maps/')),
+            ('map detail', page(views.map_detail, '/map/', slug=game.map.slug)),
+            ('map matchups', page(views.map_matchups, '/maps/matchups/')),
+            ('player profile', page(views.player_detail, '/player/', name=stat.player.name)),
+        ]
+        for sort in PlayerStat.SORT_FIELDS:
+            calls.append( ('leaderboard by %s' % sort, page(views.players, '/players/', {'sort': sort})) )
+            calls.append( ('leaderboard by %s after cursor' % sort, page(views.players, '/players/', {'sort': sort, 'after': stat.id})) )
+
+        calls += [
+            ('api games', page(api.games, '/api/games/', {'limit': 10})),
+            ('api games after cursor', page(api.games, '/api/games/', {'after': game.id, 'limit': 10})),
+            ('api game', page(api.game_detail, '/api/game/', id=str(game.id))),
+            ('api map', page(api.map_detail, '/api/map/', slug=game.map.slug)),
+            ('api players', page(api.players, '/api/players/', {'after': stat.player_id, 'limit': 10})),
+            ('api player', page(api.player_detail, '/api/player/', name=stat.player.name)),
+            ('api stats', page(api.stats, '/api/stats/')),
+            # What the importer reads when a replay file was replaced
+            ('replaced game removal', lambda: SummaryUpdater().remove_game(game)),
+        ]
+        return calls
+
+
+    def is_whole_table(self, sql):
+        return not re.search(r'\b(WHERE|LIMIT)\b', sql)
+
+
+    def explain_postgresql(self, sql, params):
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+    def explain_sqlite(self, sql, params):
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+
+    def is_scanned(self, plan, table):
+        # Postgres prints "Seq Scan on <table>", SQLite "SCAN TABLE <table>"
+        # without an index
+        for line in plan.split('\n'):
+            if re.search(r'Seq Scan on %s\b' % table, line):
+                return True
+            if re.search(r'\bSCAN (TABLE )?%s\b' % table, line) and 'INDEX' not in line:
+                return True
+        return False
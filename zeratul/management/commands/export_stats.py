@@ -0,0 +1,207 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import calendar
+import csv
+import glob
+import json
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from zeratul.models import Game, GamePlayer
+from zeratul.stats import STAT_ITEMS
+
+
+STATE_FILE = 'export_state.json'
+
+# String columns are written as int codes, an index into the column's list in
+# the state file. Lists only ever grow, so codes stay valid across
+# incremental exports.
+ENCODED_COLUMNS = ['map', 'region', 'type', 'version', 'matchup', 'winning_race', 'race', 'result', 'player', 'player_region']
+
+# (column, query field, numpy dtype) of each table
+GAME_COLUMNS = [
+    ('id', 'id', 'int32'),
+    ('started_at', 'started_at', 'int64'),
+    ('length_in_seconds', 'length_in_seconds', 'int32'),
+    ('map', 'map__name', 'int32'),
+    ('region', 'region', 'int32'),
+    ('type', 'type', 'int32'),
+    ('version', 'version', 'int32'),
+    ('num_teams', 'num_teams', 'int8'),
+    ('is_one_v_one', 'is_one_v_one', 'bool'),
+    ('matchup', 'matchup', 'int32'),
+    ('winning_race', 'winning_race', 'int32'),
+]
+
+GAME_PLAYER_COLUMNS = [
+    ('game_id', 'team__game_id', 'int32'),
+    ('team_number', 'team__team_number', 'int8'),
+    ('player_id', 'player_id', 'int32'),
+    ('player', 'player__name', 'int32'),
+    ('player_region', 'player__region', 'int32'),
+    ('race', 'race', 'int32'),
+    ('result', 'result', 'int32'),
+    ('is_human', 'is_human', 'bool'),
+    ('apm', 'apm', 'int32'),
+] + [(item, item, 'int32') for item in STAT_ITEMS]
+
+TABLES = [
+    ('games', GAME_COLUMNS),
+    ('game_players', GAME_PLAYER_COLUMNS),
+]
+
+
+class Command(BaseCommand):
+    help = 'Export games and their players to chunked, dictionary encoded CSV or NumPy .npz files for offline analysis'
+
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+            help='Directory the files are written to')
+
+        parser.add_argument('--format',
+            choices=['csv', 'npz'],
+            default='csv',
+            dest='format',
+            help='csv, or npz which needs numpy (default: csv)')
+
+        parser.add_argument('--incremental',
+            action='store_true',
+            default=False,
+            dest='incremental',
+            help='Only export the games imported since the last export to the same directory')
+
+        parser.add_argument('--chunk-size',
+            type=int,
+            default=10000,
+            dest='chunk_size',
+            help='Number of games per file (default: 10000)')
+
+
+    def execute(self, *args, **kwargs):
+        self.output = kwargs['output']
+        self.format = kwargs['format'] if 'format' in kwargs and kwargs['format'] else 'csv'
+        chunk_size = kwargs['chunk_size'] if 'chunk_size' in kwargs and kwargs['chunk_size'] else 10000
+        incremental = 'incremental' in kwargs and kwargs['incremental']
+
+        if self.format == 'npz' and numpy is None:
+            raise CommandError('--format npz needs numpy, install it or export to csv')
+
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output)
+
+        if incremental:
+            self.state = self.load_state()
+        else:
+            self.remove_exported_files()
+            self.state = {'format': self.format, 'last_game_id': 0, 'part': 0, 'dictionaries': {}}
+
+        for column in ENCODED_COLUMNS:
+            self.state['dictionaries'].setdefault(column, [])
+        self.codes = dict( (column, dict( (value, code) for code, value in enumerate(values) ))
+            for column, values in self.state['dictionaries'].items() )
+
+        # Games are exported in id order, chunk_size per file, so memory only
+        # ever holds one chunk and an interrupted export resumes after the
+        # last chunk written
+        game_count = 0
+        while True:
+            ids = list( Game.objects.filter(id__gt=self.state['last_game_id']).order_by('id').values_list('id', flat=True)[:chunk_size] )
+            if not ids:
+                break
+
+            self.state['part'] += 1
+            self.write_chunk(ids[0], ids[-1])
+
+            self.state['last_game_id'] = ids[-1]
+            self.save_state()
+
+            game_count += len(ids)
+            print 'Exported %d games' % game_count
+
+        if game_count == 0:
+            print 'No new games to export'
+
+
+    def write_chunk(self, first_id, last_id):
+        querysets = {
+            'games': Game.objects.filter(id__gte=first_id, id__lte=last_id).order_by('id'),
+            'game_players': GamePlayer.objects.filter(team__game_id__gte=first_id, team__game_id__lte=last_id).order_by('team__game_id', 'id'),
+        }
+
+        for table, columns in TABLES:
+            fields = [field for column, field, dtype in columns]
+            rows = querysets[table].values_list(*fields).iterator()
+            rows = [self.encode_row(columns, row) for row in rows]
+
+            path = os.path.join(self.output, '%s-%05d.%s' % (table, self.state['part'], self.format))
+            if self.format == 'npz':
+                self.write_npz(path, columns, rows)
+            else:
+                self.write_csv(path, columns, rows)
+
+
+    def encode_row(self, columns, row):
+        encoded = []
+        for (column, field, dtype), value in zip(columns, row):
+            if column in self.codes:
+                value = self.encode(column, value)
+            elif column == 'started_at':
+                value = calendar.timegm(value.utctimetuple())
+            encoded.append(value)
+        return encoded
+
+
+    def encode(self, column, value):
+        codes = self.codes[column]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.state['dictionaries'][column].append(value)
+        return codes[value]
+
+
+    def write_csv(self, path, columns, rows):
+        with open(path, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow([column for column, field, dtype in columns])
+            for row in rows:
+                writer.writerow([int(value) for value in row])
+
+
+    def write_npz(self, path, columns, rows):
+        arrays = {}
+        for index, (column, field, dtype) in enumerate(columns):
+            arrays[column] = numpy.array([row[index] for row in rows], dtype=dtype)
+        numpy.savez_compressed(path, **arrays)
+
+
+    def load_state(self):
+        path = os.path.join(self.output, STATE_FILE)
+        if not os.path.exists(path):
+            raise CommandError('No earlier export in %s, run without --incremental first' % self.output)
+
+        with open(path) as state_file:
+            state = json.load(state_file)
+        if state['format'] != self.format:
+            raise CommandError('%s holds a %s export, it cannot be continued as %s' % (self.output, state['format'], self.format))
+        return state
+
+
+    def save_state(self):
+        # Written to a temporary file first so a crash never leaves a torn state
+        path = os.path.join(self.output, STATE_FILE)
+        with open(path + '.tmp', 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.rename(path + '.tmp', path)
+
+
+    def remove_exported_files(self):
+        for table, columns in TABLES:
+            for path in glob.glob(os.path.join(self.output, '%s-[0-9][0-9][0-9][0-9][0-9].*' % table)):
+                os.remove(path)
+        if os.path.exists(os.path.join(self.output, STATE_FILE)):
+            os.remove(os.path.join(self.output, STATE_FILE))
@@ -1,19 +1,453 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Max
 
 import sc2reader
-import subprocess
+from sc2reader.engine.engine import GameEngine
+from sc2reader.engine.plugins import ContextLoader, GameHeartNormalizer
+import multiprocessing
+from collections import deque
 from datetime import datetime
-import io
-
-from zeratul.models import Map, Player, Game, GameTeam, GamePlayer
+from functools import partial
+from itertools import islice
+import hashlib
+import os
+import time
+
+from zeratul.models import Map, Player, Game, GameTeam, GamePlayer, ReplayFile, RaceStat
+from zeratul.cache import bump_import_generation, forget_games
+from zeratul.minimaps import MinimapProcessor, missing_files
+from zeratul.summaries import SummaryUpdater
+from zeratul.timings import ImportTimings
 
 from django.template.defaultfilters import slugify
-from PIL import Image, ImageChops
 
 from django.conf import settings
 
+
+REPLAY_SUFFIX = '.sc2replay'
+
+REGION_NAMES = {
+    'kr' : 'Korea',
+    'eu' : 'Europe',
+    'us' : 'Americas',
+}
+
+
+def iter_replay_paths(roots):
+    '''
+    Walks every root lazily and yields the absolute path of each replay file
+    as soon as its directory has been listed. A root may also be a single
+    replay file.
+    '''
+    for root in roots:
+        root = os.path.abspath(root)
+
+        if os.path.isfile(root):
+            if root.lower().endswith(REPLAY_SUFFIX):
+                yield root
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Walk in a stable order so --max picks the same replays every run
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(REPLAY_SUFFIX):
+                    yield os.path.join(dirpath, filename)
+
+
+class ReplayWatcher(object):
+    '''
+    Polls directory trees for new or changed replays without walking them.
+    Only directories whose mtime moved are listed again, known replays are
+    stat'ed one by one since overwriting a file in place leaves its directory
+    alone. A file is handed out once its size and mtime have stayed the same
+    for a whole poll, so replays that are still being copied in are not
+    picked up half written.
+    '''
+
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(root) for root in roots]
+
+        # directory -> mtime and replay path -> (size, mtime)
+        self.directories = {}
+        self.files = {}
+
+        # Files seen changing, and files that failed to import, with the
+        # (size, mtime) they had when last looked at
+        self.unsettled = {}
+        self.failed = {}
+
+        for root in self.roots:
+            self.scan_directory(root, initial=True)
+
+
+    def poll(self):
+        '''
+        Returns the replays that are new or changed and have settled since the
+        previous poll.
+        '''
+        settled = []
+        for path, previous in self.unsettled.items():
+            current = self.stat(path)
+            if current is None:
+                del self.unsettled[path]
+            elif current == previous:
+                del self.unsettled[path]
+                self.files[path] = current
+                settled.append(path)
+            else:
+                self.unsettled[path] = current
+
+        for path, previous in self.failed.items():
+            current = self.stat(path)
+            if current != previous:
+                # Replaced since it failed, give it another go once it settles
+                del self.failed[path]
+                if current is not None:
+                    self.unsettled[path] = current
+
+        for path, previous in self.files.items():
+            if path in self.unsettled or path in self.failed:
+                continue
+            current = self.stat(path)
+            if current is None:
+                # Gone, a replay showing up under the same name is new again
+                del self.files[path]
+            elif current != previous:
+                self.unsettled[path] = current
+
+        for directory, mtime in self.directories.items():
+            current = self.stat(directory)
+            if current is None:
+                self.forget_directory(directory)
+            elif current[1] != mtime:
+                self.scan_directory(directory)
+
+        for root in self.roots:
+            if root not in self.directories and os.path.isdir(root):
+                self.scan_directory(root)
+
+        return sorted(settled)
+
+
+    def recheck(self, paths):
+        # Failed files are only looked at again once they change on disk
+        for path in paths:
+            self.failed[path] = self.stat(path)
+
+
+    def scan_directory(self, directory, initial=False):
+        stat = self.stat(directory)
+        if stat is None:
+            return
+        self.directories[directory] = stat[1]
+
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if path not in self.directories:
+                    self.scan_directory(path, initial)
+            elif name.lower().endswith(REPLAY_SUFFIX):
+                current = self.stat(path)
+                if initial:
+                    # Everything already there was handled by the full import
+                    self.files[path] = current
+                elif current is not None and self.files.get(path) != current and path not in self.failed:
+                    self.unsettled[path] = current
+
+
+    def forget_directory(self, directory):
+        prefix = directory + os.sep
+        for known in [self.directories, self.files, self.unsettled, self.failed]:
+            for path in known.keys():
+                if path == directory or path.startswith(prefix):
+                    del known[path]
+
+
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+
+#
+# Replay parsing
+#
+# Everything below runs inside the worker processes when --workers is used, so
+# it must only turn a replay file into plain python data and never touch the
+# database. The Command class is the single writer that saves the records.
+#
+
+class CountingContextLoader(ContextLoader):
+    '''
+    ContextLoader that counts the game and message events of each player, the
+    ones calc_apm needs, while the engine streams through them instead of
+    appending every one of them to player.events. Saves the appends and the
+    second pass over the lists, not memory: replay.events still holds the
+    events themselves.
+    '''
+
+    def handleInitGame(self, event, replay):
+        super(CountingContextLoader, self).handleInitGame(event, replay)
+        for player in replay.entities:
+            player.action_count = 0
+            player.last_action_second = 0
+
+    def load_message_game_player(self, event, replay):
+        # Same lookup as ContextLoader, event.pid is a user id for humans
+        # since 2.0.4
+        if replay.versions[1] == 1 or (replay.versions[1] == 2 and replay.build < 24247):
+            player = replay.entity.get(event.pid)
+        elif event.pid < len(replay.humans):
+            player = replay.human[event.pid]
+        else:
+            player = None
+
+        if player is not None:
+            event.player = player
+            player.action_count += 1
+            player.last_action_second = event.second
+        elif event.pid != 16:
+            # 16 is global events
+            self.logger.error('Bad pid ({0}) for event {1} at {2}.'.format(event.pid, event.__class__, event.frame))
+
+
+def lean_engine():
+    # The default plugins, in their order. The GameHeart normalizer drops
+    # observers and moves the start time and event seconds of in-game lobby
+    # replays, lean imports must match full ones.
+    return GameEngine(plugins=[GameHeartNormalizer(), CountingContextLoader()])
+
+
+def parse_replay(path, lean=False, known_maps=()):
+    '''
+    Turns the replay at path into the record the writer imports, or None when
+    the replay is not going to be imported. In lean mode only the data the
+    importer reads is kept: events are counted instead of being collected per
+    player, the remaining event lists are dropped as soon as the numbers have
+    been taken out of them, and the map archive is only loaded when its hash
+    is not in known_maps yet.
+    '''
+    timings = {}
+
+    start = time.time()
+    if lean:
+        # Every level is still decoded, the unit counts need the tracker
+        # events and APM the game events
+        replay = sc2reader.load_replay(path, engine=lean_engine())
+    else:
+        replay = sc2reader.load_replay(path)
+    timings['parse'] = time.time() - start
+
+    if len(replay.computers) > 0:
+        # Nothing to import, the writer reports these as skipped
+        return None
+
+    start = time.time()
+    record = {
+        'path': path,
+        'game': extract_game(replay),
+        'teams': extract_teams(replay.teams),
+        'timings': timings,
+    }
+    timings['extract'] = time.time() - start
+
+    if lean:
+        drop_events(replay)
+
+        # replay.map_name is in the language of the recording client, the
+        # hash is the same for everyone
+        if replay.map_hash and replay.map_hash in known_maps:
+            # The writer already has this map, only its hash is needed
+            record['map'] = {'hash': replay.map_hash}
+            return record
+
+    start = time.time()
+    replay.load_map()
+    record['map'] = extract_map(replay.map)
+    record['map']['hash'] = replay.map_hash
+    timings['load_map'] = time.time() - start
+
+    return record
+
+
+def parse_replay_safe(path, **options):
+    # Exceptions raised by sc2reader are not always picklable, so hand the
+    # error back to the writer as a string instead of letting it escape the
+    # worker process.
+    try:
+        return path, parse_replay(path, **options), None
+    except Exception as e:
+        return path, None, '%s: %s' % (type(e), e)
+
+
+def drop_events(replay):
+    replay.events = []
+    replay.game_events = []
+    replay.tracker_events = []
+    replay.messages = []
+    replay.packets = []
+    replay.objects = {}
+    replay.active_units = {}
+    replay.units = set()
+    for player in replay.entities:
+        player.events = []
+        player.units = []
+        player.killed_units = []
+
+
+def clean_map_name(map_name):
+    if map_name.startswith('[League] '):
+        map_name = map_name[len('[League] '):]
+    return map_name
+
+
+def extract_map(map):
+    return {
+        'name': clean_map_name(map.name),
+        'description': map.description,
+        'author': map.author,
+        'website': map.website,
+        'minimap': map.minimap,
+    }
+
+
+def extract_game(replay):
+    return {
+        'started_at': replay.start_time,
+        'length_in_seconds': replay.game_events[-1].second,
+        'version': replay.release_string,
+        'type': replay.real_type,
+        'region': REGION_NAMES[replay.region] if replay.region in REGION_NAMES.keys() else replay.region,
+    }
+
+
+def extract_teams(teams):
+    team_records = []
+    for team in teams:
+        team_records.append({
+            'team_number': team.number,
+            'result': team.result,
+            'players': [extract_player(player) for player in team.players],
+        })
+    return team_records
+
+
+def extract_player(player):
+    player_data = {
+        'name': player.name,
+        'url': player.url,
+        'region': player.region,
+        'highest_league': player.highest_league,
+    }
+
+    game_player_data = {
+        'color': player.color,
+        'race': player.play_race,
+        'handicap': player.handicap,
+        'is_human': player.is_human,
+        'apm': calc_apm(player),
+    }
+
+    # Combine unit data into game_player_data
+    game_player_data.update( count_player_units(player) )
+
+    return {
+        'player': player_data,
+        'game_player': game_player_data,
+    }
+
+
+def calc_apm(player):
+    if hasattr(player, 'action_count'):
+        # Counted by the CountingContextLoader in lean mode
+        event_count = player.action_count
+        minutes = player.last_action_second/60.0
+    else:
+        event_count = len(player.events)
+        minutes = player.events[-1].second/60.0
+    return int( event_count / minutes )
+
+
+def count_player_units(player):
+    data = {
+        'workers_created': 0,
+        'workers_lost': 0,
+        'army_created': 0,
+        'army_lost': 0,
+        'buildings_created': 0,
+        'buildings_lost': 0,
+        'minerals_spent': 0,
+        'minerals_lost': 0,
+        'vespene_spent': 0,
+        'vespene_lost': 0,
+        'workers_killed': 0,
+        'army_killed': 0,
+        'buildings_killed': 0,
+    }
+
+    for unit in player.units:
+        # Ignore other unit data that doesn't relate directly to the game
+        if unit.is_army or unit.is_worker or unit.is_building:
+            if unit.finished_at > 0:
+                data['minerals_spent'] += unit.minerals
+                data['vespene_spent'] += unit.vespene
+
+            if unit.killed_by:
+                data['minerals_lost'] += unit.minerals
+                data['vespene_lost'] += unit.vespene
+
+            if unit.is_worker:
+                data['workers_created'] += 1
+                if unit.killed_by:
+                    data['workers_lost'] += 1
+
+            if unit.is_building:
+                data['buildings_created'] += 1
+                if unit.killed_by:
+                    data['buildings_lost'] += 1
+
+            if unit.is_army:
+                data['army_created'] += 1
+                if unit.killed_by:
+                    data['army_lost'] += 1
+
+    for unit in player.killed_units:
+        if unit.is_worker:
+            data['workers_killed'] += 1
+        if unit.is_army:
+            data['army_killed'] += 1
+        if unit.is_building:
+            data['buildings_killed'] += 1
+
+    return data
+
+
+def reserve_ids(model, count):
+    '''
+    Returns count primary keys for model that can be assigned before the rows
+    are created with bulk_create, which does not hand back new ids. Must be
+    called inside the transaction that inserts the rows.
+    '''
+    if count == 0:
+        return []
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [model._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+    # Without sequences the importer, being the only writer, can just count on from the highest id
+    start = (model.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+    return range(start, start + count)
+
+
 class Command(BaseCommand):
     help = 'Mass import of all replays found under the data directory'
 
@@ -21,13 +455,50 @@ class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
 
-        self.import_count = {
-            'Map': 0,
-            'Player': 0,
-            'Game': 0,
-            'GameTeam': 0,
-            'GamePlayer': 0,
-        }
+        self.reset_counts()
+
+        # path -> ReplayFile and sha1 -> ReplayFile for every known replay
+        self.manifest = {}
+        self.manifest_hashes = {}
+
+        # Whether there are games without a manifest row, imported before
+        # the manifest existed
+        self.unlinked_games = False
+
+        # path -> (size, mtime, sha1) for replays waiting to be written, and
+        # the hashes of those files
+        self.pending_files = {}
+        self.pending_hashes = set()
+
+        # name -> Map, map hash -> Map and name -> Player for every row in the
+        # database, so repeated lookups during an import never have to query
+        self.maps = {}
+        self.map_hashes = {}
+        self.players = {}
+
+        # Names added to the caches above by the batch being written, removed
+        # again if that batch is rolled back
+        self.batch_created = []
+
+        # Replays that could not be parsed or written by the last import pass
+        self.failed_paths = []
+
+        # Parser processes, kept for the whole run so --watch reuses them
+        self.pool = None
+        self.workers = 1
+
+        # Background threads that store minimaps and their thumbnails
+        self.minimaps = None
+
+        self.report_path = None
+
+        # (path, record) pairs parsed but not yet written, and the rows built
+        # from them for the current batch
+        self.batch = []
+        self.batch_size = 50
+        self.rows = {}
+        self.ids = {}
+        self.summaries = None
 
         sc2reader.configure(directory='', exclude=['Customs',], followLinks=False, depth=10)
 
@@ -41,6 +512,78 @@ class Command(BaseCommand):
 
         parser.add_argument('--max', type=int)
 
+        parser.add_argument('--path',
+            action='append',
+            dest='paths',
+            help='Directory or replay file to import, may be given more than once (default: data/replays)')
+
+        parser.add_argument('--workers',
+            type=int,
+            default=1,
+            dest='workers',
+            help='Number of processes used to parse replays (default: 1)')
+
+        parser.add_argument('--batch-size',
+            type=int,
+            default=50,
+            dest='batch_size',
+            help='Number of replays written to the database per transaction (default: 50)')
+
+        parser.add_argument('--lean',
+            action='store_true',
+            default=False,
+            dest='lean',
+            help='Only load the replay data the importer uses and skip map downloads for known maps')
+
+        parser.add_argument('--watch',
+            action='store_true',
+            default=False,
+            dest='watch',
+            help='Keep running and import new or changed replays as they appear')
+
+        parser.add_argument('--interval',
+            type=float,
+            default=5.0,
+            dest='interval',
+            help='Seconds between checks for new replays in --watch mode (default: 5)')
+
+        parser.add_argument('--retry-failed',
+            action='store_true',
+            default=False,
+            dest='retry_failed',
+            help='Only import the quarantined replays that failed on an earlier run')
+
+        parser.add_argument('--list-failed',
+            action='store_true',
+            default=False,
+            dest='list_failed',
+            help='List the quarantined replays and their errors, then exit')
+
+        parser.add_argument('--report',
+            dest='report',
+            help='Write the timing summary as JSON to this file')
+
+
+    def reset_counts(self):
+        # Counts and timings cover one import pass, in --watch mode each poll
+        # that finds replays starts a new one
+        self.import_count = {
+            'Map': 0,
+            'Player': 0,
+            'Game': 0,
+            'GameTeam': 0,
+            'GamePlayer': 0,
+        }
+
+        self.skip_count = {
+            'Unchanged': 0,
+            'Duplicate': 0,
+            'Unreadable': 0,
+            'Existing': 0,
+        }
+
+        self.timings = ImportTimings()
+
 
     def increment_import_count(self, type):
         self.import_count[type] += 1
@@ -51,238 +594,606 @@ class Command(BaseCommand):
 
 
     def execute(self, *args, **kwargs):
+        if 'list_failed' in kwargs and kwargs['list_failed']:
+            self.list_failed()
+            return
+
         if 'delete' in kwargs and kwargs['delete']:
             self.clean_database()
 
         max = -1
-        if 'max' in kwargs:
+        if 'max' in kwargs and kwargs['max']:
             max = kwargs['max']
 
-        replay_paths = self.get_replay_paths()
+        workers = 1
+        if 'workers' in kwargs and kwargs['workers']:
+            workers = kwargs['workers']
+
+        if 'batch_size' in kwargs and kwargs['batch_size']:
+            self.batch_size = kwargs['batch_size']
+
+        roots = [os.path.join(settings.BASE_DIR, 'data', 'replays')]
+        if 'paths' in kwargs and kwargs['paths']:
+            roots = kwargs['paths']
+
+        lean = 'lean' in kwargs and kwargs['lean']
+        retry_failed = 'retry_failed' in kwargs and kwargs['retry_failed']
+
+        if 'report' in kwargs and kwargs['report']:
+            self.report_path = kwargs['report']
+
+        self.load_manifest()
+        self.load_identity_cache()
+
+        watcher = None
+        if 'watch' in kwargs and kwargs['watch']:
+            # Index the trees before the first pass so nothing dropped in
+            # while it runs is missed
+            watcher = ReplayWatcher(roots)
+
+        self.start_pool(workers)
+        self.minimaps = MinimapProcessor()
+        try:
+            if retry_failed:
+                self.import_replays(self.get_failed_paths(), max, lean, retry=True)
+            else:
+                # Discovery is lazy, replays are parsed while the tree is still walked
+                self.import_replays(iter_replay_paths(roots), max, lean)
+
+            if watcher:
+                self.watch(watcher, kwargs['interval'], lean)
+        except:
+            self.stop_pool(terminate=True)
+            raise
+        else:
+            self.stop_pool()
+        finally:
+            self.minimaps.close()
+
+        self.report_timings()
+
+
+    def import_replays(self, replay_paths, max, lean, retry=False):
+        '''
+        Parses and writes every new or changed replay in replay_paths. Each
+        batch is committed together with its manifest rows, so the manifest
+        doubles as the checkpoint: a run that is killed picks up after the
+        last committed batch.
+        '''
+        self.failed_paths = []
+        self.pages_changed = False
+
+        replay_paths = self.find_changed_replays(replay_paths, retry)
+        if max > 0:
+            replay_paths = islice(replay_paths, max)
+
         count = 0
-        total = len(replay_paths)
-        for replay in sc2reader.load_replays( replay_paths ):
-            if max > 0:
-                if count == max:
-                    break
+        parse_options = {}
+        if lean:
+            parse_options = {
+                'lean': True,
+                'known_maps': frozenset(map_hash for map_hash, map in self.map_hashes.items() if map.name not in self.missing_minimaps),
+            }
 
+        for path, record, error in self.parse_replays(replay_paths, parse_options):
             count += 1
-            print 'Importing replay %d/%d' % (count, total if max < 0 else max)
+            if max > 0:
+                print 'Importing replay %d/%d' % (count, max)
+            else:
+                print 'Importing replay %d' % count
 
-            try:
-                self.import_replay( replay )
-            except Exception as e:
-                print '%s: %s' % (type(e), e)
+            if error:
+                self.quarantine(path, error)
+                continue
+
+            if record is None:
+                print 'Replay skipped due to computer players'
+            else:
+                self.timings.add_all(record.pop('timings'))
+
+            self.batch.append( (path, record) )
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
 
+        self.flush_batch()
+
+        if self.pages_changed:
+            # Cached pages and stats of the previous generation are no longer
+            # read. A pass that only skipped or linked replays keeps them, and
+            # the ETags sent with them.
+            bump_import_generation()
+
+        print '%d new or changed replays, skipped %d unchanged, %d duplicates and %d unreadable, linked %d to games imported before' % (
+            count, self.skip_count['Unchanged'], self.skip_count['Duplicate'], self.skip_count['Unreadable'], self.skip_count['Existing'])
         print self.import_count
 
 
+    def report_timings(self):
+        # Minimaps finish in the background, collect whatever is done by now
+        while self.minimaps.durations:
+            self.timings.add('minimap', self.minimaps.durations.pop())
+
+        self.timings.print_summary()
+        if self.report_path:
+            self.timings.write_report(self.report_path)
+
+
+    def watch(self, watcher, interval, lean):
+        '''
+        Stays resident and imports replays as they are dropped under the
+        watched roots. The worker pool, the manifest and the identity caches
+        are kept between polls, so each new replay only costs its own parse.
+        '''
+        # The initial pass, every later one is reported as it finishes
+        self.report_timings()
+        watcher.recheck(self.failed_paths)
+
+        print 'Watching %s for new replays' % ', '.join(watcher.roots)
+        while True:
+            time.sleep(interval)
+
+            replay_paths = watcher.poll()
+            if not replay_paths:
+                continue
+
+            # The connection may have gone away while the command sat idle
+            connection.close_if_unusable_or_obsolete()
+
+            # Report this pass only, not the time spent waiting for it
+            self.reset_counts()
+            self.import_replays(replay_paths, -1, lean)
+            watcher.recheck(self.failed_paths)
+            self.report_timings()
+
+
+    def start_pool(self, workers):
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            # Forked workers must not share the writer's database connection
+            connection.close()
+            self.pool = multiprocessing.Pool(workers)
+
+
+    def stop_pool(self, terminate=False):
+        if self.pool is None:
+            return
+
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+
+    def parse_replays(self, replay_paths, parse_options):
+        '''
+        Yields (path, record, error) for every replay, in the same order as
+        replay_paths. With more than one worker the parsing is spread over a
+        process pool while this process stays the only database writer.
+
+        replay_paths is consumed on this thread, a few replays ahead of the
+        results, so discovery and the manifest checks never run concurrently
+        with the writer.
+        '''
+        parse = partial(parse_replay_safe, **parse_options)
+
+        if self.pool is None:
+            for path in replay_paths:
+                yield parse(path)
+            return
+
+        pending = deque()
+        for path in replay_paths:
+            pending.append( self.pool.apply_async(parse, (path,)) )
+            if len(pending) >= self.workers * 2:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+
     def clean_database(self):
+        forget_games(Game.objects.values_list('id', flat=True).iterator())
+        ReplayFile.objects.all().delete()
+        RaceStat.objects.all().delete()
         Map.objects.all().delete()
         Player.objects.all().delete()
         GamePlayer.objects.all().delete()
         GameTeam.objects.all().delete()
         Game.objects.all().delete()
+        bump_import_generation()
 
 
-    def get_replay_paths(self):
-        response = subprocess.check_output('find . | grep .SC2Replay', shell=True)
-        replay_paths = [x for x in response.split('\n')]
-        print '%d SC2 replays found' % len(replay_paths)
-        return replay_paths
+    def list_failed(self):
+        for replay_file in ReplayFile.objects.filter(status=ReplayFile.FAILED).order_by('path'):
+            print '%s\n    %s' % (replay_file.path, replay_file.error)
 
 
-    def import_replay(self, replay):
-        if len(replay.computers) > 0:
-            print 'Replay skipped due to computer players'
+    def get_failed_paths(self):
+        paths = ReplayFile.objects.filter(status=ReplayFile.FAILED).order_by('path').values_list('path', flat=True)
+        return [path for path in paths if os.path.isfile(path)]
+
+
+    def load_manifest(self):
+        for replay_file in ReplayFile.objects.all():
+            self.remember_replay_file(replay_file)
+        self.unlinked_games = Game.objects.filter(replay_files=None).exists()
+
+
+    def remember_replay_file(self, replay_file):
+        self.manifest[replay_file.path] = replay_file
+        if replay_file.status != ReplayFile.FAILED:
+            # Copies of a quarantined replay are not linked to it
+            self.manifest_hashes[replay_file.sha1] = replay_file
+
+
+    def load_identity_cache(self):
+        self.maps = dict( (map.name, map) for map in Map.objects.all() )
+        self.map_hashes = dict( (map.map_hash, map) for map in self.maps.values() if map.map_hash )
+        # Maps whose minimap files are gone, stored again from the next
+        # replay played on them
+        self.missing_minimaps = set( name for name, map in self.maps.items() if missing_files(map) )
+        self.players = dict( (player.name, player) for player in Player.objects.all() )
+
+
+    def find_changed_replays(self, replay_paths, retry=False):
+        '''
+        Filters replay_paths down to the files that still need to be parsed.
+        Files whose size and mtime match the manifest are skipped without being
+        read, everything else is hashed so touched or copied replays that were
+        already imported are not imported a second time. Quarantined files
+        are only skipped while unchanged, or always when retrying.
+        '''
+        for path in replay_paths:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                # Removed since it was listed, or a broken link
+                self.skip_unreadable(path, e)
+                continue
+
+            known = self.manifest.get(path)
+            if known and known.size == stat.st_size and known.mtime == stat.st_mtime:
+                if not (retry and known.status == ReplayFile.FAILED):
+                    self.skip_count['Unchanged'] += 1
+                    continue
+
+            try:
+                with self.timings.time('hash'):
+                    sha1 = self.hash_replay(path)
+            except (IOError, OSError) as e:
+                self.skip_unreadable(path, e)
+                continue
+            duplicate = self.manifest_hashes.get(sha1)
+            if duplicate:
+                # Touched, or a copy of a replay that has already been imported
+                self.save_replay_file(path, stat.st_size, stat.st_mtime, sha1, duplicate.game, duplicate.status)
+                self.skip_count['Unchanged' if duplicate.path == path else 'Duplicate'] += 1
+                continue
+
+            if sha1 in self.pending_hashes:
+                # A copy of a replay that is still being imported, the next
+                # run links it to the same game
+                self.skip_count['Duplicate'] += 1
+                continue
+
+            self.pending_files[path] = (stat.st_size, stat.st_mtime, sha1)
+            self.pending_hashes.add(sha1)
+            yield path
+
+
+    def skip_unreadable(self, path, error):
+        print 'Skipping %s, %s' % (path, error)
+        self.skip_count['Unreadable'] += 1
+
+
+    def hash_replay(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as replay_file:
+            for chunk in iter(lambda: replay_file.read(65536), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+
+    def save_replay_file(self, path, size, mtime, sha1, game, status, error=''):
+        replay_file = self.manifest.get(path) or ReplayFile(path=path)
+        replay_file.size = size
+        replay_file.mtime = mtime
+        replay_file.sha1 = sha1
+        replay_file.game = game
+        replay_file.status = status
+        replay_file.error = error
+        replay_file.save()
+
+        self.remember_replay_file(replay_file)
+
+
+    def quarantine(self, path, error):
+        print 'Quarantined %s\n    %s' % (path, error)
+        self.failed_paths.append(path)
+
+        size, mtime, sha1 = self.pending_files.pop(path)
+        self.pending_hashes.discard(sha1)
+
+        # A file that was imported before keeps its old game until a working
+        # version of it comes along
+        known = self.manifest.get(path)
+        game = known.game if known else None
+        self.save_replay_file(path, size, mtime, sha1, game, ReplayFile.FAILED, error)
+
+
+    def flush_batch(self):
+        if not self.batch:
             return
 
-        replay.load_map()
-        map = self.import_map(replay.map)
-        cur_game = self.import_game(replay, map)
-        self.import_teams(replay.teams, cur_game)
+        batch, self.batch = self.batch, []
 
+        error = self.write_atomic(batch)
+        if error is None:
+            return
 
-    def import_game(self, replay, map):
+        if len(batch) == 1:
+            self.quarantine(batch[0][0], error)
+            return
 
-        region_map = {
-            'kr' : 'Korea',
-            'eu' : 'Europe',
-            'us' : 'Americas',
+        # Write the replays one by one so only the broken ones are quarantined
+        print 'Batch of %d replays failed, %s' % (len(batch), error)
+        for item in batch:
+            error = self.write_atomic([item])
+            if error is not None:
+                self.quarantine(item[0], error)
+
+
+    def write_atomic(self, batch):
+        '''
+        Writes batch in a single transaction. Returns None on success, or the
+        error once everything the batch did has been rolled back.
+        '''
+        import_count = self.import_count.copy()
+        self.batch_created = []
+        self.removed_game_ids = []
+        self.batch_minimaps = []
+        self.batch_linked_game_ids = set()
+
+        try:
+            with self.timings.time('write'), transaction.atomic():
+                replay_files = self.write_batch(batch)
+        except Exception as e:
+            self.import_count = import_count
+            for cache, name in self.batch_created:
+                del cache[name]
+            return '%s: %s' % (type(e), e)
+
+        self.timings.replay_count += len(batch)
+        self.skip_count['Existing'] += len(self.batch_linked_game_ids)
+
+        # Games added or removed, or minimaps stored again
+        if self.rows[Game] or self.removed_game_ids or self.batch_minimaps:
+            self.pages_changed = True
+
+        # Only once committed, or a page could cache the old game again
+        forget_games(self.removed_game_ids)
+        self.missing_minimaps.difference_update(name for name, sha1 in self.batch_minimaps)
+
+        for replay_file in replay_files:
+            del self.pending_files[replay_file.path]
+            self.pending_hashes.discard(replay_file.sha1)
+            self.remember_replay_file(replay_file)
+
+        return None
+
+
+    def write_batch(self, batch):
+        '''
+        Builds the rows for every replay in batch and inserts them with one
+        bulk_create per table. Ids are reserved up front so teams and players
+        can point at rows that do not exist yet.
+        '''
+        records = [record for path, record in batch if record is not None]
+        team_count = sum(len(record['teams']) for record in records)
+
+        self.ids = {
+            Game: iter( reserve_ids(Game, len(records)) ),
+            GameTeam: iter( reserve_ids(GameTeam, team_count) ),
+            ReplayFile: iter( reserve_ids(ReplayFile, len([path for path, record in batch if path not in self.manifest])) ),
         }
-
-        game_data = {
-            'map': map,
-            'started_at': replay.start_time,
-            'length_in_seconds': replay.game_events[-1].second,
-            'version': replay.release_string,
-            'type': replay.real_type,
-            'region': region_map[replay.region] if replay.region in region_map.keys() else replay.region,
+        self.rows = {
+            Game: [],
+            GameTeam: [],
+            GamePlayer: [],
+            ReplayFile: [],
         }
+        # Summary tables are updated in the same transaction as the games
+        self.summaries = SummaryUpdater()
+
+        for path, record in batch:
+            game = self.import_replay(record) if record is not None else None
+            self.import_replay_file(path, game)
+
+        # Maps are only committed once their minimap files exist, a minimap
+        # that cannot be stored fails the batch like any other error
+        for name, sha1 in self.batch_minimaps:
+            self.minimaps.wait(sha1)
+
+        for model in [Game, GameTeam, GamePlayer]:
+            model.objects.bulk_create(self.rows[model])
+        self.summaries.save()
+
+        # Existing manifest rows are updated, new ones inserted
+        replay_files = self.rows[ReplayFile]
+        for replay_file in replay_files:
+            if replay_file.path in self.manifest:
+                replay_file.save()
+        ReplayFile.objects.bulk_create([replay_file for replay_file in replay_files if replay_file.path not in self.manifest])
+
+        return replay_files
+
+
+    def import_replay_file(self, path, game):
+        size, mtime, sha1 = self.pending_files[path]
+
+        replay_file = ReplayFile(path=path, size=size, mtime=mtime, sha1=sha1, game=game,
+            status=ReplayFile.IMPORTED if game else ReplayFile.SKIPPED)
+
+        known = self.manifest.get(path)
+        if known:
+            replay_file.id = known.id
+            if known.game_id:
+                # The file was replaced with a different replay, drop the old
+                # game without cascading into the manifest row being updated
+                ReplayFile.objects.filter(id=known.id).update(game=None)
+                for old_game in Game.objects.filter(id=known.game_id):
+                    self.summaries.remove_game(old_game)
+                    old_game.delete()
+                    self.removed_game_ids.append(known.game_id)
+        else:
+            replay_file.id = next(self.ids[ReplayFile])
 
-        cur_game = Game(**game_data)
-        cur_game.save()
+        self.rows[ReplayFile].append(replay_file)
+        return replay_file
 
-        self.increment_import_count('Game')
 
+    def import_replay(self, record):
+        map = self.import_map(record['map'])
+
+        if self.unlinked_games:
+            existing_game = self.find_existing_game(record, map)
+            if existing_game:
+                # Imported before the manifest existed, only the manifest row
+                # is new
+                self.batch_linked_game_ids.add(existing_game.id)
+                return existing_game
+
+        cur_game = self.import_game(record['game'], map)
+        self.import_teams(record['teams'], cur_game)
         return cur_game
 
 
-    def import_map(self, map):
-        map_name = map.name
-        if map_name.startswith('[League] '):
-            map_name = map_name[len('[League] '):]
+    def find_existing_game(self, record, map):
+        '''
+        The game record was imported as before there was a manifest: same
+        start time, map and players, and no replay file linked to it yet.
+        '''
+        games = Game.objects.filter(started_at=record['game']['started_at'], map=map, replay_files=None)
+        # Games linked by this batch have no manifest row until it is written
+        game_ids = [game_id for game_id in games.values_list('id', flat=True) if game_id not in self.batch_linked_game_ids]
+        if not game_ids:
+            return None
 
+        names = sorted(player['player']['name'] for team in record['teams'] for player in team['players'])
+        game_names = dict( (game_id, []) for game_id in game_ids )
+        for game_id, name in GamePlayer.objects.filter(team__game_id__in=game_ids).values_list('team__game_id', 'player__name'):
+            game_names[game_id].append(name)
 
-        if Map.objects.filter(name=map_name).exists():
-            # This map has already been imported, nothing to do here
-            return Map.objects.get(name=map_name)
+        for game_id in game_ids:
+            if sorted(game_names[game_id]) == names:
+                return Game.objects.get(id=game_id)
+        return None
 
 
+    def import_game(self, game_data, map):
+        cur_game = Game(id=next(self.ids[Game]), map=map, **game_data)
+        self.rows[Game].append(cur_game)
+
+        self.increment_import_count('Game')
+
+        return cur_game
+
+
+    def import_map(self, map):
+        # Lean records of known maps only carry the hash
+        map_hash = map['hash']
+        known_map = self.map_hashes.get(map_hash) or self.maps.get(map.get('name'))
+
+        if known_map:
+            changed = False
+            if map_hash and map_hash not in self.map_hashes:
+                # A new version of the map, or a map stored before hashes were
+                self.cache_identity(self.map_hashes, map_hash, known_map)
+                known_map.map_hash = map_hash
+                changed = True
+
+            repairing = [name for name, sha1 in self.batch_minimaps]
+            if known_map.name in self.missing_minimaps and known_map.name not in repairing and map.get('minimap'):
+                # Lost, or never written by the run that created the map
+                self.set_minimap(known_map, map['minimap'])
+                changed = True
+
+            if changed:
+                known_map.save()
+            return known_map
+
+        map_name = map['name']
+
         map_data = {
             'name': map_name,
             'slug': slugify(map_name),
-            'description': map.description,
-            'author': map.author,
-            'website': map.website,
-            'minimap': self.handle_minimap( map_name, map.minimap )
+            'description': map['description'],
+            'author': map['author'],
+            'website': map['website'],
         }
 
-        new_map = Map(**map_data)
+        new_map = Map(map_hash=map_hash, **map_data)
+        self.set_minimap(new_map, map['minimap'])
         new_map.save()
+        self.cache_identity(self.maps, map_name, new_map)
+        if map_hash:
+            self.cache_identity(self.map_hashes, map_hash, new_map)
         self.increment_import_count('Map')
         return new_map
 
 
+    def set_minimap(self, map, minimap_data):
+        # Decoding, resizing and encoding happen on the processor's threads,
+        # the filenames only depend on the image content
+        minimap_hash, minimap_files = self.minimaps.process(minimap_data)
+        self.batch_minimaps.append( (map.name, minimap_hash) )
+
+        map.minimap = minimap_files['full']
+        map.minimap_hash = minimap_hash
+        map.minimap_small = minimap_files['small']
+        map.minimap_large = minimap_files['large']
+
+
+    def cache_identity(self, cache, name, obj):
+        cache[name] = obj
+        self.batch_created.append( (cache, name) )
+
+
     def import_teams(self, teams, game):
+        lineup = []
         for team in teams:
             team_data = {
-                'team_number': team.number,
-                'result': team.result,
+                'team_number': team['team_number'],
+                'result': team['result'],
                 'game': game
             }
 
-            cur_team = GameTeam(**team_data)
-            cur_team.save()
+            cur_team = GameTeam(id=next(self.ids[GameTeam]), **team_data)
+            self.rows[GameTeam].append(cur_team)
             self.increment_import_count('GameTeam')
 
-            for player in team.players:
-                game_player = self.import_player(player, cur_team)
+            game_players = []
+            for player in team['players']:
+                game_players.append( self.import_player(player, cur_team) )
+            lineup.append( (team['result'], game_players) )
+
+        game.set_lineup(lineup)
+        self.summaries.add_game(game, [game_player for result, game_players in lineup for game_player in game_players])
 
 
     def import_player(self, player_data, team):
-        player = None
-        if Player.objects.filter(name=player_data.name).exists():
-            player = Player.objects.get(name=player_data.name)
-        else:
-            new_player_data = {
-                'name': player_data.name,
-                'url': player_data.url,
-                'region': player_data.region,
-                'highest_league': player_data.highest_league,
-            }
-            player = Player(**new_player_data)
+        player = self.players.get(player_data['player']['name'])
+        if player is None:
+            player = Player(**player_data['player'])
             player.save()
+            self.cache_identity(self.players, player.name, player)
             self.increment_import_count('Player')
 
-        game_player_data = {
-            'player': player,
-            'color': player_data.color,
-            'race': player_data.play_race,
-            'handicap': player_data.handicap,
-            'is_human': player_data.is_human,
-            'apm' : self.calc_apm(player_data),
-            'team': team
-        }
-
-        unit_data = self.import_player_units( player_data )
-
-        # Combine unit_data into game_player_data
-        game_player_data.update( unit_data )
-
-        game_player = GamePlayer(**game_player_data)
-        game_player.save()
+        game_player = GamePlayer(player=player, team=team, game=team.game, result=team.result, **player_data['game_player'])
+        self.rows[GamePlayer].append(game_player)
 
         self.increment_import_count('GamePlayer')
         return game_player
-
-    def calc_apm(self, player):
-        event_count = len(player.events)
-        minutes = player.events[-1].second/60.0
-        return int( event_count / minutes )
-
-    def import_player_units(self, player):
-        data = {
-            'workers_created': 0,
-            'workers_lost': 0,
-            'army_created': 0,
-            'army_lost': 0,
-            'buildings_created': 0,
-            'buildings_lost': 0,
-            'minerals_spent': 0,
-            'minerals_lost': 0,
-            'vespene_spent': 0,
-            'vespene_lost': 0,
-            'workers_killed': 0,
-            'army_killed': 0,
-            'buildings_killed': 0,
-        }
-
-        for unit in player.units:
-            # Ignore other unit data that doesn't relate directly to the game
-            if unit.is_army or unit.is_worker or unit.is_building:
-                if unit.finished_at > 0:
-                    data['minerals_spent'] += unit.minerals
-                    data['vespene_spent'] += unit.vespene
-
-                if unit.killed_by:
-                    data['minerals_lost'] += unit.minerals
-                    data['vespene_lost'] += unit.vespene
-
-                if unit.is_worker:
-                    data['workers_created'] += 1
-                    if unit.killed_by:
-                        data['workers_lost'] += 1
-
-                if unit.is_building:
-                    data['buildings_created'] += 1
-                    if unit.killed_by:
-                        data['buildings_lost'] += 1
-
-                if unit.is_army:
-                    data['army_created'] += 1
-                    if unit.killed_by:
-                        data['army_lost'] += 1
-
-        for unit in player.killed_units:
-            if unit.is_worker:
-                data['workers_killed'] += 1
-            if unit.is_army:
-                data['army_killed'] += 1
-            if unit.is_building:
-                data['buildings_killed'] += 1
-
-        return data
-
-
-    def handle_minimap(self, minimap_name, minimap_data):
-        minimap_file = io.BytesIO(minimap_data)
-        im = Image.open(minimap_file)
-        im = self.trim(im)
-
-        filename = slugify(minimap_name) + '.png'
-        file_path = settings.MEDIA_ROOT + filename
-
-        im.save(file_path, 'png')
-
-        return filename
-
-
-    def trim(self, im):
-        bg = Image.new(im.mode, im.size, im.getpixel((0,0)))
-        diff = ImageChops.difference(im, bg)
-        diff = ImageChops.add(diff, diff, 2.0, -100)
-        bbox = diff.getbbox()
-        if bbox:
-            return im.crop(bbox)
-
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from django.db import transaction
+
+from zeratul.cache import bump_import_generation
+from zeratul.summaries import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Recompute the race, map matchup and player summary tables from the imported games'
+
+
+    def execute(self, *args, **kwargs):
+        with transaction.atomic():
+            rebuild_summaries()
+
+        # Pages and stats cached from the old summaries are no longer read
+        bump_import_generation()
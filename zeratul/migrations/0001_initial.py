@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Game',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started_at', models.DateTimeField()),
+                ('length_in_seconds', models.IntegerField()),
+                ('expansion', models.CharField(max_length=31)),
+                ('version', models.CharField(max_length=31)),
+                ('type', models.CharField(max_length=15)),
+                ('region', models.CharField(max_length=31)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GamePlayer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('color', models.CharField(max_length=31)),
+                ('race', models.CharField(max_length=7)),
+                ('handicap', models.IntegerField()),
+                ('is_human', models.BooleanField()),
+                ('army_created', models.IntegerField()),
+                ('army_lost', models.IntegerField()),
+                ('army_killed', models.IntegerField()),
+                ('buildings_created', models.IntegerField()),
+                ('buildings_lost', models.IntegerField()),
+                ('buildings_killed', models.IntegerField()),
+                ('workers_created', models.IntegerField()),
+                ('workers_lost', models.IntegerField()),
+                ('workers_killed', models.IntegerField()),
+                ('minerals_spent', models.IntegerField()),
+                ('minerals_lost', models.IntegerField()),
+                ('vespene_spent', models.IntegerField()),
+                ('vespene_lost', models.IntegerField()),
+                ('apm', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameTeam',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('team_number', models.IntegerField()),
+                ('result', models.CharField(max_length=7)),
+                ('game', models.ForeignKey(related_name='teams', to='zeratul.Game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Map',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=127)),
+                ('slug', models.CharField(unique=True, max_length=127)),
+                ('author', models.CharField(max_length=63)),
+                ('website', models.CharField(max_length=255)),
+                ('description', models.CharField(max_length=255)),
+                ('minimap', models.ImageField(upload_to=b'')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Player',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=63)),
+                ('region', models.CharField(max_length=31)),
+                ('url', models.CharField(max_length=255)),
+                ('highest_league', models.IntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='player',
+            field=models.ForeignKey(to='zeratul.Player'),
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='team',
+            field=models.ForeignKey(related_name='players', to='zeratul.GameTeam'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='map',
+            field=models.ForeignKey(related_name='games', to='zeratul.Map'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplayFile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.CharField(unique=True, max_length=511)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('sha1', models.CharField(max_length=40, db_index=True)),
+                ('imported_at', models.DateTimeField(auto_now=True)),
+                ('game', models.ForeignKey(related_name='replay_files', to='zeratul.Game', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0002_replay_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='map',
+            name='minimap_hash',
+            field=models.CharField(db_index=True, max_length=40, blank=True),
+        ),
+        migrations.AddField(
+            model_name='map',
+            name='minimap_large',
+            field=models.ImageField(upload_to=b'', blank=True),
+        ),
+        migrations.AddField(
+            model_name='map',
+            name='minimap_small',
+            field=models.ImageField(upload_to=b'', blank=True),
+        ),
+    ]
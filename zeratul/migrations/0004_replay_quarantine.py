@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_skipped_replays(apps, schema_editor):
+    # Rows without a game were replays skipped on purpose (computer players)
+    ReplayFile = apps.get_model('zeratul', 'ReplayFile')
+    ReplayFile.objects.filter(game__isnull=True).update(status='skipped')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0003_minimap_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replayfile',
+            name='error',
+            field=models.TextField(default=b'', blank=True),
+        ),
+        migrations.AddField(
+            model_name='replayfile',
+            name='status',
+            field=models.CharField(default=b'imported', max_length=15, db_index=True, choices=[(b'imported', b'Imported'), (b'skipped', b'Skipped'), (b'failed', b'Failed')]),
+        ),
+        migrations.RunPython(mark_skipped_replays, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0004_replay_quarantine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='is_one_v_one',
+            field=models.BooleanField(default=False, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='lineup',
+            field=models.CharField(max_length=127, blank=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='matchup',
+            field=models.CharField(db_index=True, max_length=3, blank=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='num_teams',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='winner',
+            field=models.ForeignKey(related_name='games_won', blank=True, to='zeratul.Player', null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='winning_race',
+            field=models.CharField(db_index=True, max_length=7, blank=True),
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='game',
+            field=models.ForeignKey(related_name='players', to='zeratul.Game', null=True),
+        ),
+        migrations.AddField(
+            model_name='gameplayer',
+            name='result',
+            field=models.CharField(db_index=True, max_length=7, blank=True),
+        ),
+    ]
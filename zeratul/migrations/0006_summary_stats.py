@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0005_game_lineup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapMatchupStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('matchup', models.CharField(max_length=3)),
+                ('winning_race', models.CharField(max_length=7, blank=True)),
+                ('count', models.IntegerField(default=0)),
+                ('map', models.ForeignKey(related_name='matchup_stats', to='zeratul.Map')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlayerStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('games', models.IntegerField(default=0)),
+                ('wins', models.IntegerField(default=0)),
+                ('losses', models.IntegerField(default=0)),
+                ('apm_total', models.BigIntegerField(default=0)),
+                ('max_apm', models.IntegerField(default=0)),
+                ('player', models.OneToOneField(related_name='stat', to='zeratul.Player')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RaceStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('race', models.CharField(max_length=7)),
+                ('result', models.CharField(max_length=7, blank=True)),
+                ('count', models.IntegerField(default=0)),
+                ('army_killed', models.BigIntegerField(default=0)),
+                ('army_created', models.BigIntegerField(default=0)),
+                ('army_lost', models.BigIntegerField(default=0)),
+                ('buildings_created', models.BigIntegerField(default=0)),
+                ('buildings_lost', models.BigIntegerField(default=0)),
+                ('buildings_killed', models.BigIntegerField(default=0)),
+                ('workers_created', models.BigIntegerField(default=0)),
+                ('workers_lost', models.BigIntegerField(default=0)),
+                ('workers_killed', models.BigIntegerField(default=0)),
+                ('minerals_spent', models.BigIntegerField(default=0)),
+                ('minerals_lost', models.BigIntegerField(default=0)),
+                ('vespene_spent', models.BigIntegerField(default=0)),
+                ('vespene_lost', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='racestat',
+            unique_together=set([('race', 'result')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='mapmatchupstat',
+            unique_together=set([('map', 'matchup', 'winning_race')]),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Only 1v1 games are grouped by map, matchup and winning race, so the index
+# behind the matchup stats leaves every other game out. Django 1.8 cannot
+# declare partial indexes, and only Postgres gets one here.
+ONE_V_ONE_INDEX = 'zeratul_game_one_v_one_matchup'
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE INDEX %s ON zeratul_game (map_id, matchup, winning_race) WHERE is_one_v_one' % ONE_V_ONE_INDEX)
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % ONE_V_ONE_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0007_game_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='game',
+            index_together=set([('map', 'started_at'), ('started_at', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='gameplayer',
+            index_together=set([('player', 'result'), ('race', 'result')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='gameteam',
+            index_together=set([('game', 'result')]),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_win_rates(apps, schema_editor):
+    PlayerStat = apps.get_model('zeratul', 'PlayerStat')
+    win_rate = models.ExpressionWrapper(models.F('wins')*100.0/models.F('games'), output_field=models.FloatField())
+    PlayerStat.objects.filter(games__gt=0).update(win_rate=win_rate)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0008_analytics_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playerstat',
+            name='win_rate',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AlterIndexTogether(
+            name='playerstat',
+            index_together=set([('games', 'id'), ('max_apm', 'id'), ('win_rate', 'id')]),
+        ),
+        migrations.RunPython(fill_win_rates, migrations.RunPython.noop),
+    ]
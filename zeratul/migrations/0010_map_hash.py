@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zeratul', '0009_leaderboard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='map',
+            name='map_hash',
+            field=models.CharField(db_index=True, max_length=64, blank=True),
+        ),
+    ]
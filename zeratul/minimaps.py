@@ -0,0 +1,131 @@
+import hashlib
+import io
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from PIL import Image, ImageChops
+
+
+MINIMAP_DIRECTORY = 'minimaps'
+
+# Longest side in pixels of the thumbnails stored next to the full minimap
+THUMBNAIL_SIZES = {
+    'small': 160,
+    'large': 320,
+}
+
+
+def minimap_hash(minimap_data):
+    return hashlib.sha1(minimap_data).hexdigest()
+
+
+def minimap_filenames(sha1):
+    '''
+    Names of every stored variant of a minimap, relative to MEDIA_ROOT. They
+    only depend on the image content, so identical minimaps share their files.
+    '''
+    filenames = {
+        'full': os.path.join(MINIMAP_DIRECTORY, sha1 + '.png'),
+    }
+    for size in THUMBNAIL_SIZES:
+        filenames[size] = os.path.join(MINIMAP_DIRECTORY, '%s-%s.jpg' % (sha1, size))
+    return filenames
+
+
+def missing_files(map):
+    '''
+    True when the minimap of map or one of its thumbnails is not on disk, or
+    was never stored: maps imported before thumbnails existed only have the
+    full image and no hash.
+    '''
+    fields = [map.minimap, map.minimap_small, map.minimap_large]
+    if not map.minimap_hash or not all(fields):
+        return True
+    return not all(os.path.exists(os.path.join(settings.MEDIA_ROOT, field.name)) for field in fields)
+
+
+def process_minimap(minimap_data, sha1):
+    filenames = minimap_filenames(sha1)
+    paths = dict( (variant, os.path.join(settings.MEDIA_ROOT, filename)) for variant, filename in filenames.items() )
+
+    if all(os.path.exists(path) for path in paths.values()):
+        # Already processed by an earlier import
+        return filenames
+
+    directory = os.path.join(settings.MEDIA_ROOT, MINIMAP_DIRECTORY)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    im = trim( Image.open(io.BytesIO(minimap_data)) )
+    im.save(paths['full'], 'png', optimize=True)
+
+    thumbnail_source = im.convert('RGB')
+    for size, max_length in THUMBNAIL_SIZES.items():
+        thumbnail = thumbnail_source.copy()
+        thumbnail.thumbnail((max_length, max_length), Image.ANTIALIAS)
+        thumbnail.save(paths[size], 'jpeg', quality=85, optimize=True)
+
+    return filenames
+
+
+def trim(im):
+    bg = Image.new(im.mode, im.size, im.getpixel((0,0)))
+    diff = ImageChops.difference(im, bg)
+    diff = ImageChops.add(diff, diff, 2.0, -100)
+    bbox = diff.getbbox()
+    if bbox:
+        return im.crop(bbox)
+    return im
+
+
+class MinimapProcessor(object):
+    '''
+    Decodes, trims, resizes and encodes minimaps on background threads. Each
+    distinct image is processed once per run, however many maps use it, and
+    the filenames are known as soon as the work is queued. wait() blocks
+    until they have been written.
+    '''
+
+    def __init__(self, threads=2):
+        self.pool = ThreadPool(threads)
+        self.results = {}
+
+        # Seconds spent on each processed minimap
+        self.durations = []
+
+    def process(self, minimap_data):
+        sha1 = minimap_hash(minimap_data)
+        if sha1 not in self.results:
+            self.results[sha1] = self.pool.apply_async(self._process, (minimap_data, sha1))
+        return sha1, minimap_filenames(sha1)
+
+    def wait(self, sha1):
+        '''
+        Blocks until the minimap sha1 has been stored and raises whatever
+        stopped it. A failed minimap is processed again when next queued.
+        '''
+        try:
+            return self.results[sha1].get()
+        except Exception:
+            del self.results[sha1]
+            raise
+
+    def _process(self, minimap_data, sha1):
+        start = time.time()
+        try:
+            return process_minimap(minimap_data, sha1)
+        finally:
+            self.durations.append(time.time() - start)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+        for sha1, result in self.results.items():
+            try:
+                result.get()
+            except Exception as e:
+                print 'Minimap %s could not be processed, %s: %s' % (sha1, type(e), e)
@@ -1,8 +1,11 @@
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import Avg, Q, Sum, Min, Max
+from django.db import connection, models
+from django.db.models import Avg, Count, Prefetch, Q, Sum, Min, Max
 from django.template.defaultfilters import slugify
 
+from zeratul.cache import cached_by_import, get_many_by_game
+from zeratul.stats import STAT_ITEMS, matchup_stats, matchup_stats_by_map, player_matchup, win_records
+
 
 
 #
@@ -40,31 +43,89 @@ def _convert_length(dict):
     return dict
 
 
+RACES = ['Zerg', 'Terran', 'Protoss']
+
+def matchup_name(race1, race2):
+    '''
+    Short name of a 1v1 matchup (ZvT, TvP, PvP, ...), always ordered Zerg,
+    Terran, Protoss so both sides of a matchup share the same name.
+    '''
+    if race1 not in RACES or race2 not in RACES:
+        return ''
+    race1, race2 = sorted([race1, race2], key=RACES.index)
+    return race1[0] + 'v' + race2[0]
+
+
+def keyset_page(queryset, field, per_page, after=None, before=None):
+    '''
+    One page of queryset ordered by field then id, both descending, seeking
+    from the id of the last (after) or first (before) row of the current
+    page instead of using OFFSET. Needs an index on (field, id) to cost the
+    same on every page. Returns the rows and the after/before ids of the
+    next and previous pages, None where there is no such page.
+    '''
+    cursor_id = after or before
+    if cursor_id:
+        try:
+            value = queryset.model.objects.values_list(field, flat=True).get(id=cursor_id)
+        except ObjectDoesNotExist:
+            cursor_id = after = before = None
+
+    if after:
+        queryset = queryset.filter(Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': cursor_id}))
+    elif before:
+        queryset = queryset.filter(Q(**{field + '__gt': value}) | Q(**{field: value, 'id__gt': cursor_id}))
+
+    if before:
+        # Walk back towards the start, then flip the page around
+        rows = list( queryset.order_by(field, 'id')[:per_page+1] )
+        has_more = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_next, has_prev = True, has_more
+    else:
+        rows = list( queryset.order_by('-' + field, '-id')[:per_page+1] )
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        has_next, has_prev = has_more, bool(after)
+
+    return rows, rows[-1].id if rows and has_next else None, rows[0].id if rows and has_prev else None
+
+
 
 class MapManager(models.Manager):
 
+    @cached_by_import('maps')
     def get_all(self):
+        '''
+        Every map with its play count, average game length and total time
+        played, from one annotated query.
+        '''
         maps = []
-        for map in Map.objects.all():
-            maps.append( map.as_dict() )
+        annotated = Map.objects.annotate(
+            game_count=Count('games'),
+            avg_length=Avg('games__length_in_seconds'),
+            total_length=Sum('games__length_in_seconds'),
+        ).order_by('name')
+        for map in annotated:
+            map_dict = map.as_dict(play_count=map.game_count)
+            map_dict['avg_game_length'] = _length_to_minutes_and_seconds(map.avg_length or 0)
+            map_dict['total_time_played'] = _length_to_days_hours_minutes_seconds(map.total_length or 0)
+            maps.append( map_dict )
         return maps
 
-    def _get_game_summaries_for_map(self, map):
-        return [ _convert_length(game.summary_dict()) for game in map.games.all().order_by('-started_at')]
-
-
+    @cached_by_import('map_details')
     def get_all_map_details(self, slug):
         try:
-            map = Map.objects.prefetch_related('games').get(slug=slug)
-            map_dict = map.as_dict()
+            map = Map.objects.get(slug=slug)
+            data = map.games.aggregate(Count('id'), Avg('length_in_seconds'), Sum('length_in_seconds'))
+
+            map_dict = map.as_dict(play_count=data['id__count'])
             map_dict['stats'] = map.compute_race_stats()
 
-            map_dict['games'] = self._get_game_summaries_for_map(map)
+            # Only the ids, the rows are rendered from the per game cache
+            map_dict['game_ids'] = list( map.games.order_by('-started_at', '-id').values_list('id', flat=True) )
 
-            data = map.games.aggregate(Avg('length_in_seconds'))
             map_dict['avg_game_length'] = _length_to_minutes_and_seconds(data['length_in_seconds__avg'])
-
-            data = map.games.aggregate(Sum('length_in_seconds'))
             map_dict['total_time_played'] = _length_to_days_hours_minutes_seconds(data['length_in_seconds__sum'])
 
             return map_dict
@@ -72,6 +133,26 @@ class MapManager(models.Manager):
             return {}
 
 
+    @cached_by_import('matchup_matrix')
+    def get_matchup_matrix(self):
+        '''
+        Every map with its 1v1 matchup stats, computed for all maps with a
+        single grouped query.
+        '''
+        stats_by_map = matchup_stats_by_map(MapMatchupStat.objects.values('map_id', 'matchup', 'winning_race', 'count'))
+
+        maps = []
+        for map in Map.objects.order_by('name'):
+            if map.id not in stats_by_map:
+                continue
+            maps.append({
+                'name': map.name,
+                'slug': map.slug,
+                'stats': stats_by_map[map.id],
+            })
+        return maps
+
+
 class Map(models.Model):
     '''
     'archive', 'author', 'dependencies',
@@ -87,8 +168,21 @@ class Map(models.Model):
     description = models.CharField(max_length=255)
     minimap = models.ImageField()
 
+    # Thumbnails generated from the minimap, shared by maps with the same image
+    minimap_hash = models.CharField(max_length=40, blank=True, db_index=True)
+    minimap_small = models.ImageField(blank=True)
+    minimap_large = models.ImageField(blank=True)
+
+    # Hash of the map archive named in the replay details. Unlike the name
+    # there, which is in the language of the client that saved the replay, it
+    # is the same for every replay of this version of the map.
+    map_hash = models.CharField(max_length=64, blank=True, db_index=True)
+
+
+    def as_dict(self, play_count=None):
+        if play_count is None:
+            play_count = Game.objects.filter(map=self).count()
 
-    def as_dict(self):
         map_dict = {
             'name': self.name,
             'slug': self.slug,
@@ -96,90 +190,145 @@ class Map(models.Model):
             'website': self.website,
             'description': self.description,
             'minimap_url': self.minimap.url,
-            'play_count': Game.objects.filter(map=self).count(),
+            'minimap_small_url': self.minimap_small_url(),
+            'minimap_large_url': self.minimap_large_url(),
+            'play_count': play_count,
         }
 
         return map_dict
 
+    def minimap_small_url(self):
+        # Maps imported before thumbnails existed only have the full image
+        return self.minimap_small.url if self.minimap_small else self.minimap.url
 
-    def compute_race_stats(self):
-        stats = {
-            'ZvT': {},
-            'ZvP': {},
-            'TvP': {},
-            'ZvZ': {},
-            'TvT': {},
-            'PvP': {}
-        }
-
-        stats['ZvZ']['Count'] = self.get_mirror_match_count('Zerg')
-        stats['TvT']['Count'] = self.get_mirror_match_count('Terran')
-        stats['PvP']['Count'] = self.get_mirror_match_count('Protoss')
-
-        stats['ZvT']['Count'] = self.get_match_count('Zerg', 'Terran')
-        stats['ZvT']['Zerg'] = self.get_match_win_count('Zerg', 'Terran')
-        stats['ZvT']['Terran'] = self.get_match_win_count('Terran', 'Zerg')
-        stats['ZvT']['percent_zerg'] = 100.0*float(stats['ZvT']['Zerg'])/float(stats['ZvT']['Count']) if stats['ZvT']['Count'] > 0 else 50.0
-        stats['ZvT']['percent_terran'] = 100.0*float(stats['ZvT']['Terran'])/float(stats['ZvT']['Count']) if stats['ZvT']['Count'] > 0 else 50.0
+    def minimap_large_url(self):
+        return self.minimap_large.url if self.minimap_large else self.minimap.url
 
-        stats['ZvP']['Count'] = self.get_match_count('Zerg', 'Protoss')
-        stats['ZvP']['Zerg'] = self.get_match_win_count('Zerg', 'Protoss')
-        stats['ZvP']['Protoss'] = self.get_match_win_count('Protoss', 'Zerg')
-        stats['ZvP']['percent_zerg'] = 100.0*float(stats['ZvP']['Zerg'])/float(stats['ZvP']['Count']) if stats['ZvP']['Count'] > 0 else 50.0
-        stats['ZvP']['percent_protoss'] = 100.0*float(stats['ZvP']['Protoss'])/float(stats['ZvP']['Count']) if stats['ZvP']['Count'] > 0 else 50.0
 
-        stats['TvP']['Count'] = self.get_match_count('Terran', 'Protoss')
-        stats['TvP']['Terran'] = self.get_match_win_count('Terran', 'Protoss')
-        stats['TvP']['Protoss'] = self.get_match_win_count('Protoss', 'Terran')
-        stats['TvP']['percent_terran'] = 100.0*float(stats['TvP']['Terran'])/float(stats['TvP']['Count']) if stats['TvP']['Count'] > 0 else 50.0
-        stats['TvP']['percent_protoss'] = 100.0*float(stats['TvP']['Protoss'])/float(stats['TvP']['Count']) if stats['TvP']['Count'] > 0 else 50.0
-
-        return stats
+    def compute_race_stats(self):
+        return matchup_stats(self.matchup_stats.values('matchup', 'winning_race', 'count'))
 
     def get_match_count(self, race1, race2):
         # assert( race1 != race2 )
-        r1_games = self.games.filter(type='1v1', teams__players__race=race1)
-        r2_games = self.games.filter(type='1v1', teams__players__race=race2)
-        return len(list( set(r1_games) & set(r2_games) ))
+        return self.games.filter(matchup=matchup_name(race1, race2)).count()
 
     def get_match_win_count(self, winning_race, losing_race):
-        r1_games = self.games.filter(type='1v1', teams__players__race=winning_race, teams__result='Win')
-        r2_games = self.games.filter(type='1v1', teams__players__race=losing_race, teams__result='Loss')
-        return len(list( set(r1_games) & set(r2_games) ))
+        return self.games.filter(matchup=matchup_name(winning_race, losing_race), winning_race=winning_race).count()
 
     def get_mirror_match_count(self, race):
-        races = ['Zerg', 'Terran', 'Protoss']
-        races.remove( race )
-        return self.games.filter(Q(type='1v1') & ~Q(teams__players__race=races[0]) & ~Q(teams__players__race=races[1])).count()
+        return self.games.filter(matchup=matchup_name(race, race)).count()
 
 #
 # Player
 #
 class PlayerManager(models.Manager):
 
+    def _stat_for(self, player_name, field):
+        result = PlayerStat.objects.filter(player__name=player_name).values_list(field, flat=True)
+        return result[0] if result else 0
+
     def total_wins_for(self, player_name):
-        return Game.objects.filter( Q(teams__players__player__name=player_name) & Q(teams__result='Win') ).count()
+        return self._stat_for(player_name, 'wins')
 
     def total_losses_for(self, player_name):
-        return Game.objects.filter( Q(teams__players__player__name=player_name) & Q(teams__result='Loss')).count()
+        return self._stat_for(player_name, 'losses')
 
     def total_games_for(self, player_name):
-        return Game.objects.filter( Q(teams__players__player__name=player_name) ).count()
+        return self._stat_for(player_name, 'games')
 
     def max_apm_for(self, player_name):
+        return self._stat_for(player_name, 'max_apm')
+
+
+    @cached_by_import('player_profile')
+    def get_player_profile(self, name, recent_count=10):
+        '''
+        Everything the player page shows: the overall record and APM from
+        the player's summary row, the record per matchup and per map from one
+        grouped query over the player's games, and the most recent games.
+        Returns None for an unknown player.
+        '''
         try:
-            player = Player.objects.get(name=player_name)
-            result = player.gameplayer_set.aggregate(Max('apm'))
-            return result['apm__avg']
+            player = Player.objects.get(name=name)
         except ObjectDoesNotExist:
-            return 0
+            return None
 
+        try:
+            stat = PlayerStat.objects.get(player=player)
+        except ObjectDoesNotExist:
+            stat = PlayerStat(player=player)
+
+        profile = {
+            'name': player.name,
+            'region': player.region,
+            'url': player.url,
+            'highest_league': player.highest_league,
+            'games': stat.games,
+            'wins': stat.wins,
+            'losses': stat.losses,
+            'win_rate': 100.0*stat.wins/stat.games if stat.games > 0 else 0.0,
+            'avg_apm': float(stat.apm_total)/stat.games if stat.games > 0 else 0.0,
+            'max_apm': stat.max_apm,
+        }
+
+        rows = list( GamePlayer.objects.filter(player=player).values(
+            'race', 'result', 'game__matchup', 'game__map__name', 'game__map__slug').annotate(count=Count('id')).order_by() )
+        profile['matchups'] = win_records(rows, lambda row: player_matchup(row['race'], row['game__matchup']))
+        profile['races'] = win_records(rows, lambda row: row['race'])
+        profile['maps'] = win_records(rows, lambda row: row['game__map__name'])
+
+        slugs = dict( (row['game__map__name'], row['game__map__slug']) for row in rows )
+        for record in profile['maps']:
+            record['slug'] = slugs[record['name']]
+
+        recent = Game.objects.filter(players__player=player).order_by('-started_at', '-id').values_list('id', flat=True)[:recent_count]
+        profile['recent_games'] = Game.objects.get_game_summaries(list(recent))
+
+        return profile
+
+    def get_leaderboard_page(self, sort, per_page, after=None, before=None):
+        '''
+        A page of the leaderboard sorted by one of PlayerStat.SORT_FIELDS,
+        highest first, with keyset pagination on the indexed (sort, id)
+        columns. after and before are PlayerStat ids, as in
+        GameManager.get_game_ids_page.
+        '''
+        stats = PlayerStat.objects.select_related('player')
+        stats, after, before = keyset_page(stats, sort, per_page, after, before)
+
+        players = []
+        for stat in stats:
+            players.append({
+                'name': stat.player.name,
+                'region': stat.player.region,
+                'games': stat.games,
+                'wins': stat.wins,
+                'losses': stat.losses,
+                'win_rate': stat.win_rate,
+                'avg_apm': float(stat.apm_total)/stat.games if stat.games > 0 else 0.0,
+                'max_apm': stat.max_apm,
+            })
+
+        return {
+            'players': players,
+            'after': after,
+            'before': before,
+        }
+
+    @cached_by_import('player_count')
+    def cached_count(self):
+        return PlayerStat.objects.count()
+
+    @cached_by_import('average_apm')
     def average_apm(self):
-        result = Player.objects.all().aggregate(Avg('gameplayer__apm'))
-        return result['gameplayer__apm__avg']
+        result = PlayerStat.objects.aggregate(Sum('apm_total'), Sum('games'))
+        if not result['games__sum']:
+            return None
+        return float(result['apm_total__sum'])/result['games__sum']
 
+    @cached_by_import('average_of_best_apms')
     def average_of_best_apms(self):
-        result = Player.objects.all().annotate(max_apm=Max('gameplayer__apm')).aggregate(Avg('max_apm'))
+        result = PlayerStat.objects.aggregate(Avg('max_apm'))
         return result['max_apm__avg']
 
 
@@ -204,8 +353,60 @@ class Player(models.Model):
 #
 class GameManager(models.Manager):
 
-    def get_paged_game_summaries(self, start=0, end=10):
-        return [ _convert_length( game.summary_dict() ) for game in Game.objects.all().order_by('-started_at')[start:end] ]
+    def with_teams(self):
+        '''
+        Games with their map, teams, players and player names loaded up front,
+        so summarizing them takes the same few queries however many there are.
+        '''
+        players = GamePlayer.objects.select_related('player')
+        return self.get_queryset().select_related('map').prefetch_related('teams', Prefetch('teams__players', queryset=players))
+
+    def get_game_summaries(self, ids):
+        '''
+        Summaries of the games with ids, in that order. A game's summary never
+        changes once it is imported, so they are cached per game and only the
+        games summarized for the first time are loaded, together.
+        '''
+        def load(missing):
+            games = Game.objects.with_teams().filter(id__in=missing)
+            return dict( (game.id, _convert_length( game.summary_dict() )) for game in games )
+        return get_many_by_game('summary', ids, load)
+
+
+    def get_paged_game_ids(self, start=0, end=10):
+        return list( Game.objects.order_by('-started_at', '-id').values_list('id', flat=True)[start:end] )
+
+
+    def get_game_ids_page(self, per_page, after=None, before=None):
+        '''
+        Keyset pagination over games, newest first. after and before are the
+        ids of the last and first game of the page currently shown. Seeks on
+        the (started_at, id) index, so every page costs the same however deep
+        it is. Returns the game ids plus the after/before ids of the next and
+        previous pages, None where there is no such page.
+        '''
+        games, after, before = keyset_page(Game.objects.only('id', 'started_at'), 'started_at', per_page, after, before)
+        return {
+            'ids': [game.id for game in games],
+            'after': after,
+            'before': before,
+        }
+
+
+    @cached_by_import('game_count')
+    def cached_count(self):
+        '''
+        Number of games for display, without a COUNT(*) over the whole table
+        on every request. Large Postgres tables use the planner's estimate.
+        '''
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [Game._meta.db_table])
+            row = cursor.fetchone()
+            # The estimate is only good once the table has been analyzed and is big
+            if row and row[0] > 100000:
+                return int(row[0])
+        return Game.objects.count()
 
 
     def get_games_for_player(self, player):
@@ -214,17 +415,19 @@ class GameManager(models.Manager):
 
     def get_game_detail_for_id(self, id):
         try:
-            game = Game.objects.get(id=id)
+            game = Game.objects.with_teams().get(id=id)
             return _convert_length( game.detail_dict() )
         except ObjectDoesNotExist as e:
             return None
 
 
 
+    @cached_by_import('average_game_length')
     def average_game_length(self):
         data = Game.objects.aggregate(Avg('length_in_seconds'))
         return _length_to_minutes_and_seconds(int(data['length_in_seconds__avg']))
 
+    @cached_by_import('total_gameplay_time')
     def total_gameplay_time(self):
         data = Game.objects.aggregate(Sum('length_in_seconds'))
         return _length_to_days_hours_minutes_seconds(int(data['length_in_seconds__sum']))
@@ -238,26 +441,30 @@ class GameManager(models.Manager):
         pass
 
     def num_1v1_wins(self, race):
-        return Game.objects.filter(Q(teams__players__race=race) & Q(teams__result='Win')).count()
+        return GamePlayer.objects.filter(race=race, result='Win').count()
 
     def number_of_games_with(self, race):
-        return Game.objects.filter(Q(teams__players__race=race)).count()
+        return GamePlayer.objects.filter(race=race).count()
+
+    @cached_by_import('race_result_totals')
+    def race_result_totals(self):
+        # Per race and result sums of the unit and resource columns
+        return list( RaceStat.objects.values('race', 'result', 'count', *STAT_ITEMS) )
+
+    @cached_by_import('race_stats')
+    def race_stats(self):
+        # Counts and wins of every 1v1 matchup, summed over the map summaries
+        return matchup_stats(MapMatchupStat.objects.values('matchup', 'winning_race', 'count'))
 
     def get_match_count(self, race1, race2):
         # assert( race1 != race2 )
-        r1_games = Game.objects.filter(type='1v1', teams__players__race=race1)
-        r2_games = Game.objects.filter(type='1v1', teams__players__race=race2)
-        return len(list( set(r1_games) & set(r2_games) ))
+        return self.race_stats()[matchup_name(race1, race2)]['Count']
 
     def get_match_win_count(self, winning_race, losing_race):
-        r1_games = Game.objects.filter(type='1v1', teams__players__race=winning_race, teams__result='Win')
-        r2_games = Game.objects.filter(type='1v1', teams__players__race=losing_race, teams__result='Loss')
-        return len(list( set(r1_games) & set(r2_games) ))
+        return self.race_stats()[matchup_name(winning_race, losing_race)].get(winning_race, 0)
 
     def get_mirror_match_count(self, race):
-        races = ['Zerg', 'Terran', 'Protoss']
-        races.remove( race )
-        return Game.objects.filter(Q(type='1v1') & ~Q(teams__players__race=races[0]) & ~Q(teams__players__race=races[1])).count()
+        return self.race_stats()[matchup_name(race, race)]['Count']
 
     def get_all_TvPs(self):
         pass
@@ -282,8 +489,8 @@ class GameManager(models.Manager):
     def average_generic_by_race(self, race, item, result=None):
         if result != None:
             result = 'Win' if result == True else 'Loss'
-            result = Game.objects.filter(teams__players__race=race, teams__result=result).aggregate(Avg('teams__players__' + item))
-            return result['teams__players__' + item + '__avg']
+            result = GamePlayer.objects.filter(race=race, result=result).aggregate(Avg(item))
+            return result[item + '__avg']
         else:
             result = Game.objects.filter(teams__players__race=race).aggregate(Avg('teams__players__' + item))
             return result['teams__players__' + item + '__avg']
@@ -322,6 +529,25 @@ class Game(models.Model):
     region = models.CharField(max_length=31)
     map = models.ForeignKey(Map, related_name='games')
 
+    # Filled in from the teams when the game is imported, see set_lineup
+    num_teams = models.IntegerField(default=0)
+    is_one_v_one = models.BooleanField(default=False, db_index=True)
+    # Races per team, teams separated by | and players by a comma
+    lineup = models.CharField(max_length=127, blank=True)
+    # ZvT, TvP, ... for 1v1 games, blank otherwise
+    matchup = models.CharField(max_length=3, blank=True, db_index=True)
+    # Race and player that won a 1v1 game
+    winning_race = models.CharField(max_length=7, blank=True, db_index=True)
+    winner = models.ForeignKey(Player, null=True, blank=True, related_name='games_won')
+
+    class Meta:
+        index_together = [
+            # Keyset pagination of the games list seeks on this
+            ('started_at', 'id'),
+            # Games of a map, newest first
+            ('map', 'started_at'),
+        ]
+
     '''
     def type():
         # Return the game type (1v1, 2v2, etc)
@@ -335,9 +561,9 @@ class Game(models.Model):
             'type': self.get_game_type(),
             'region': self.region,
             'map_name': self.map.name,
-            'map_image_url': self.map.minimap.url,
+            'map_image_url': self.map.minimap_small_url(),
             'expansion': self.get_expansion_name(),
-            'teams': [team.summary_dict() for team in self.teams.all().order_by('team_number')]
+            'teams': [team.summary_dict() for team in self.sorted_teams()]
         }
 
 
@@ -349,12 +575,17 @@ class Game(models.Model):
             'type': self.get_game_type(),
             'region': self.region,
             'map_name': self.map.name,
-            'map_image_url': self.map.minimap.url,
+            'map_image_url': self.map.minimap_large_url(),
             'expansion': self.get_expansion_name(),
-            'teams': [team.summary_dict() for team in self.teams.all().order_by('team_number')]
+            'teams': [team.summary_dict() for team in self.sorted_teams()]
         }
 
 
+    def sorted_teams(self):
+        # Sorted here rather than with order_by so prefetched teams are used
+        return sorted(self.teams.all(), key=lambda team: team.team_number)
+
+
     def get_expansion_name(self):
         if self.version.startswith('1'):
             return 'Wings of Liberty'
@@ -371,8 +602,27 @@ class Game(models.Model):
         if self.version.startswith('3'):
             return 'LoTV'
 
+    def set_lineup(self, teams):
+        '''
+        Sets the lineup columns from teams, a list of (result, game_players)
+        ordered by team number. Called by the importer and backfill_lineups.
+        '''
+        self.num_teams = len(teams)
+        self.is_one_v_one = len(teams) == 2 and all(len(game_players) == 1 for result, game_players in teams)
+        self.lineup = '|'.join(','.join(game_player.race for game_player in game_players) for result, game_players in teams)
+
+        self.matchup = ''
+        self.winning_race = ''
+        self.winner_id = None
+        if self.is_one_v_one:
+            self.matchup = matchup_name(teams[0][1][0].race, teams[1][1][0].race)
+            for result, game_players in teams:
+                if result == 'Win':
+                    self.winning_race = game_players[0].race
+                    self.winner_id = game_players[0].player_id
+
     def team_count(self):
-        return self.teams.count()
+        return self.num_teams
 
 
     def get_game_type(self):
@@ -382,35 +632,11 @@ class Game(models.Model):
             return self.type
 
     def is_1v1(self):
-        if self.team_count() != 2:
-            return False
-
-        for team in self.teams.all():
-            if team.player_count() != 1:
-                return False
-        return True
+        return self.is_one_v_one
 
 
     def get_1v1_type(self):
-        if not self.is_1v1():
-            return ''
-
-        races = self.race_counts()
-
-        if races['Protoss'] == 1 and races['Terran'] == 1 and races['Zerg'] == 0:
-            return 'TvP'
-        if races['Protoss'] == 1 and races['Terran'] == 0 and races['Zerg'] == 1:
-            return 'ZvP'
-        if races['Protoss'] == 0 and races['Terran'] == 1 and races['Zerg'] == 1:
-            return 'ZvT'
-        if races['Protoss'] == 2 and races['Terran'] == 0 and races['Zerg'] == 0:
-            return 'PvP'
-        if races['Protoss'] == 0 and races['Terran'] == 2 and races['Zerg'] == 0:
-            return 'TvT'
-        if races['Protoss'] == 0 and races['Terran'] == 0 and races['Zerg'] == 2:
-            return 'ZvZ'
-
-        return ''
+        return self.matchup
 
     def is_TvP(self):
         return self.get_1v1_type() == 'TvP'
@@ -439,15 +665,15 @@ class Game(models.Model):
         }
         for team in self.team_lineups():
             for player_race in team:
-                race_counts[player_race] += 1
+                if player_race in race_counts:
+                    race_counts[player_race] += 1
         return race_counts
 
 
     def team_lineups(self):
-        team_races = []
-        for team in self.teams.all():
-            team_races.append( team.player_races() )
-        return team_races
+        if not self.lineup:
+            return []
+        return [ [race for race in team.split(',') if race] for team in self.lineup.split('|') ]
 
 
     def winning_team(self):
@@ -462,7 +688,7 @@ class Game(models.Model):
 
 
     def get_1v1_winner(self):
-        return self.winning_team().players.all()[0]
+        return self.players.filter(result='Win')[0]
 
 
 
@@ -475,6 +701,11 @@ class GameTeam(models.Model):
     result = models.CharField(max_length=7)
     game = models.ForeignKey(Game, related_name='teams')
 
+    class Meta:
+        index_together = [
+            ('game', 'result'),
+        ]
+
     def player_races(self):
         # Return list of races on the team
         player_races = []
@@ -512,6 +743,9 @@ class GameTeam(models.Model):
 class GamePlayer(models.Model):
     player = models.ForeignKey(Player, null=False)
     team = models.ForeignKey(GameTeam, related_name='players')
+    # Copied from the team so per player win queries skip the GameTeam join
+    game = models.ForeignKey(Game, null=True, related_name='players')
+    result = models.CharField(max_length=7, blank=True, db_index=True)
     color = models.CharField(max_length=31)
     race = models.CharField(max_length=7)
     handicap = models.IntegerField()
@@ -537,6 +771,12 @@ class GamePlayer(models.Model):
 
     apm = models.IntegerField()
 
+    class Meta:
+        index_together = [
+            ('race', 'result'),
+            ('player', 'result'),
+        ]
+
     def as_dict(self):
         return {
             'name': player.name,
@@ -582,3 +822,107 @@ class GamePlayer(models.Model):
     def get_player_name(self):
         return player.name
 
+
+#
+# Replay manifest
+#
+class ReplayFile(models.Model):
+    '''
+    One row per replay file seen by import_replays. size and mtime let an
+    unchanged file be skipped without reading it, sha1 catches files that were
+    touched or copied without their content changing.
+
+    Files that could not be imported are kept here too, with the error, as
+    the quarantine list that import_replays --retry-failed works from.
+    '''
+    IMPORTED = 'imported'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (IMPORTED, 'Imported'),
+        (SKIPPED, 'Skipped'),
+        (FAILED, 'Failed'),
+    )
+
+    path = models.CharField(max_length=511, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    sha1 = models.CharField(max_length=40, db_index=True)
+    # Null for replays that were parsed but intentionally not imported
+    game = models.ForeignKey(Game, null=True, related_name='replay_files')
+    imported_at = models.DateTimeField(auto_now=True)
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES, default=IMPORTED, db_index=True)
+    error = models.TextField(blank=True, default='')
+
+
+
+#
+# Summaries
+#
+# Counters kept up to date by import_replays in the same transaction as the
+# games they count, see zeratul.summaries. rebuild_stats recomputes them from
+# scratch.
+#
+class RaceStat(models.Model):
+    '''
+    Number of game players and the sum of each unit and resource column for
+    one race and result, the rows stat_matrix works from.
+    '''
+    race = models.CharField(max_length=7)
+    result = models.CharField(max_length=7, blank=True)
+    count = models.IntegerField(default=0)
+
+    army_killed = models.BigIntegerField(default=0)
+    army_created = models.BigIntegerField(default=0)
+    army_lost = models.BigIntegerField(default=0)
+
+    buildings_created = models.BigIntegerField(default=0)
+    buildings_lost = models.BigIntegerField(default=0)
+    buildings_killed = models.BigIntegerField(default=0)
+
+    workers_created = models.BigIntegerField(default=0)
+    workers_lost = models.BigIntegerField(default=0)
+    workers_killed = models.BigIntegerField(default=0)
+
+    minerals_spent = models.BigIntegerField(default=0)
+    minerals_lost = models.BigIntegerField(default=0)
+
+    vespene_spent = models.BigIntegerField(default=0)
+    vespene_lost = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('race', 'result')
+
+
+class MapMatchupStat(models.Model):
+    # Number of 1v1 games of a matchup on a map won by winning_race
+    map = models.ForeignKey(Map, related_name='matchup_stats')
+    matchup = models.CharField(max_length=3)
+    winning_race = models.CharField(max_length=7, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('map', 'matchup', 'winning_race')
+
+
+class PlayerStat(models.Model):
+    # Columns the leaderboard can be sorted by, each indexed together with id
+    SORT_FIELDS = ['games', 'win_rate', 'max_apm']
+
+    player = models.OneToOneField(Player, related_name='stat')
+    games = models.IntegerField(default=0)
+    wins = models.IntegerField(default=0)
+    losses = models.IntegerField(default=0)
+    # Percentage of games won, stored so the leaderboard can sort on an index
+    win_rate = models.FloatField(default=0.0)
+    # Sum of the apm of every game, divide by games for the average
+    apm_total = models.BigIntegerField(default=0)
+    max_apm = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [
+            ('games', 'id'),
+            ('win_rate', 'id'),
+            ('max_apm', 'id'),
+        ]
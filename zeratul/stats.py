@@ -0,0 +1,202 @@
+from collections import defaultdict
+
+from django.db.models import Count, Sum
+
+
+# GamePlayer columns summed up per race on the dashboard and in RaceStat
+UNIT_ITEMS = ['army_killed', 'army_created', 'army_lost',
+        'buildings_created', 'buildings_lost', 'buildings_killed',
+        'workers_created', 'workers_lost', 'workers_killed']
+
+RESOURCE_ITEMS = ['minerals_spent', 'minerals_lost', 'vespene_spent', 'vespene_lost']
+
+STAT_ITEMS = UNIT_ITEMS + RESOURCE_ITEMS
+
+
+#
+# Matchup statistics
+#
+
+# Matchups between two different races, with the race names used as keys
+NON_MIRROR_MATCHUPS = {
+    'ZvT': ('Zerg', 'Terran'),
+    'ZvP': ('Zerg', 'Protoss'),
+    'TvP': ('Terran', 'Protoss'),
+}
+
+MIRROR_MATCHUPS = ['ZvZ', 'TvT', 'PvP']
+
+MATCHUPS = ['ZvT', 'ZvP', 'TvP', 'ZvZ', 'TvT', 'PvP']
+
+
+def empty_matchup_stats():
+    stats = {}
+    for matchup in MATCHUPS:
+        stats[matchup] = {'Count': 0}
+    for matchup, races in NON_MIRROR_MATCHUPS.items():
+        for race in races:
+            stats[matchup][race] = 0
+    return stats
+
+
+def finish_matchup_stats(stats):
+    '''
+    Adds percent_<race> to every non mirror matchup, 50% when no game of the
+    matchup has been played.
+    '''
+    for matchup, races in NON_MIRROR_MATCHUPS.items():
+        count = stats[matchup]['Count']
+        for race in races:
+            percent = 100.0*float(stats[matchup][race])/float(count) if count > 0 else 50.0
+            stats[matchup]['percent_' + race.lower()] = percent
+    return stats
+
+
+def _add_matchup_row(stats, row):
+    matchup = row['matchup']
+    if matchup not in stats:
+        return
+    stats[matchup]['Count'] += row['count']
+    if row['winning_race'] in stats[matchup]:
+        stats[matchup][row['winning_race']] += row['count']
+
+
+def matchup_rows(games):
+    '''
+    Number of 1v1 games per map, matchup and winning race in games, a Game
+    queryset, from a single grouped query. These are the rows stored in
+    MapMatchupStat.
+    '''
+    return games.filter(is_one_v_one=True).values('map_id', 'matchup', 'winning_race').annotate(count=Count('id')).order_by()
+
+
+def matchup_stats(rows):
+    '''
+    Game count and wins per race for every 1v1 matchup, summed over rows
+    with matchup, winning_race and count keys. The result has the layout of
+    Map.compute_race_stats: stats['ZvT']['Count'], stats['ZvT']['Zerg'],
+    stats['ZvT']['percent_zerg'], ...
+    '''
+    stats = empty_matchup_stats()
+    for row in rows:
+        _add_matchup_row(stats, row)
+    return finish_matchup_stats(stats)
+
+
+def matchup_stats_by_map(rows):
+    '''
+    Same as matchup_stats but split by the map_id of each row. Returns a
+    dict of map id to stats, maps without 1v1 games are missing.
+    '''
+    stats_by_map = defaultdict(empty_matchup_stats)
+    for row in rows:
+        _add_matchup_row(stats_by_map[row['map_id']], row)
+
+    for stats in stats_by_map.values():
+        finish_matchup_stats(stats)
+    return dict(stats_by_map)
+
+
+#
+# Unit and resource statistics
+#
+
+def race_result_totals(game_players, items):
+    '''
+    Player count and the sum of every item for each (race, result) pair in
+    game_players, a GamePlayer queryset, from a single grouped query. The
+    rows are what RaceStat stores and what stat_matrix and race_records
+    aggregate further.
+    '''
+    sums = dict( (item, Sum(item)) for item in items )
+    return list( game_players.values('race', 'result').annotate(count=Count('id'), **sums).order_by() )
+
+
+def _total(rows, item, race=None, result=None):
+    count = 0
+    total = 0
+    for row in rows:
+        if race is not None and row['race'] != race:
+            continue
+        if result is not None and row['result'] != result:
+            continue
+        count += row['count']
+        if item is not None:
+            total += row[item] or 0
+    return count, total
+
+
+def _average(count, total):
+    return float(total)/count if count > 0 else None
+
+
+def stat_matrix(rows, items, races):
+    '''
+    One list per item: the item name, total, average, then for every race
+    its total, average, average in wins and average in losses.
+    '''
+    matrix = []
+    for item in items:
+        count, total = _total(rows, item)
+        cur_item = [item, total, _average(count, total)]
+
+        for race in races:
+            count, total = _total(rows, item, race=race)
+            cur_item.append( total )
+            cur_item.append( _average(count, total) )
+            cur_item.append( _average(*_total(rows, item, race=race, result='Win')) )
+            cur_item.append( _average(*_total(rows, item, race=race, result='Loss')) )
+        matrix.append( cur_item )
+    return matrix
+
+
+def race_records(rows, races):
+    records = {}
+    for race in races:
+        games, total = _total(rows, None, race=race)
+        wins, total = _total(rows, None, race=race, result='Win')
+        records[race] = {
+            'wins': wins,
+            'games': games,
+            'win_rate': float(wins)/float(games)*100.0 if games > 0 else 0.0,
+        }
+    return records
+
+
+#
+# Player statistics
+#
+
+def player_matchup(race, matchup):
+    '''
+    A 1v1 matchup from the point of view of a player of race, e.g. TvZ for
+    a Terran player in a ZvT game. Blank for games that are not 1v1.
+    '''
+    if not matchup or not race:
+        return ''
+    own = race[0]
+    other = matchup[2] if matchup[0] == own else matchup[0]
+    return own + 'v' + other
+
+
+def win_records(rows, key):
+    '''
+    Games, wins, losses and win rate per key(row), summed over rows with
+    result and count keys. Rows whose key is blank are left out. Sorted by
+    games played, most first.
+    '''
+    records = {}
+    for row in rows:
+        name = key(row)
+        if not name:
+            continue
+        record = records.setdefault(name, {'name': name, 'games': 0, 'wins': 0, 'losses': 0})
+        record['games'] += row['count']
+        if row['result'] == 'Win':
+            record['wins'] += row['count']
+        elif row['result'] == 'Loss':
+            record['losses'] += row['count']
+
+    for record in records.values():
+        record['win_rate'] = 100.0*record['wins']/record['games'] if record['games'] > 0 else 0.0
+    return sorted(records.values(), key=lambda record: (-record['games'], record['name']))
@@ -0,0 +1,120 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, IntegerField, Max, Sum, When
+
+from zeratul.models import Game, GamePlayer, RaceStat, MapMatchupStat, PlayerStat
+from zeratul.stats import STAT_ITEMS, matchup_rows, race_result_totals
+
+
+class SummaryUpdater(object):
+    '''
+    Collects how a batch of imported (or removed) games changes the summary
+    tables and applies it with one UPDATE or INSERT per summary row. Meant to
+    be saved inside the transaction that writes the games.
+    '''
+
+    def __init__(self):
+        self.races = defaultdict(Counter)
+        self.matchups = Counter()
+        self.players = defaultdict(Counter)
+        self.max_apms = {}
+        # Players whose best game may have been removed
+        self.stale_max_apm = set()
+
+    def add_game(self, game, game_players, sign=1):
+        '''
+        Counts game and its game_players, or takes them out again with
+        sign=-1. Works on unsaved objects, only the lineup columns of game and
+        the result, player_id and stat columns of game_players are read.
+        '''
+        for game_player in game_players:
+            race = self.races[(game_player.race, game_player.result)]
+            race['count'] += sign
+            for item in STAT_ITEMS:
+                race[item] += sign*getattr(game_player, item)
+
+            player = self.players[game_player.player_id]
+            player['games'] += sign
+            player['wins'] += sign*(game_player.result == 'Win')
+            player['losses'] += sign*(game_player.result == 'Loss')
+            player['apm_total'] += sign*game_player.apm
+
+            if sign > 0:
+                self.max_apms[game_player.player_id] = max(game_player.apm, self.max_apms.get(game_player.player_id, 0))
+            else:
+                self.stale_max_apm.add(game_player.player_id)
+
+        if game.is_one_v_one:
+            self.matchups[(game.map_id, game.matchup, game.winning_race)] += sign
+
+    def remove_game(self, game):
+        self.add_game(game, list(GamePlayer.objects.filter(team__game=game)), sign=-1)
+
+    def save(self):
+        for (race, result), deltas in self.races.items():
+            _apply(RaceStat, {'race': race, 'result': result}, deltas)
+
+        for (map_id, matchup, winning_race), count in self.matchups.items():
+            _apply(MapMatchupStat, {'map_id': map_id, 'matchup': matchup, 'winning_race': winning_race}, {'count': count})
+
+        for player_id, deltas in self.players.items():
+            _apply(PlayerStat, {'player_id': player_id}, deltas)
+        update_win_rates(PlayerStat.objects.filter(player_id__in=list(self.players)))
+
+        for player_id, max_apm in self.max_apms.items():
+            PlayerStat.objects.filter(player_id=player_id, max_apm__lt=max_apm).update(max_apm=max_apm)
+
+        for player_id in self.stale_max_apm:
+            result = GamePlayer.objects.filter(player_id=player_id).aggregate(Max('apm'))
+            PlayerStat.objects.filter(player_id=player_id).update(max_apm=result['apm__max'] or 0)
+
+        if self.stale_max_apm:
+            # Games were removed, drop whatever no longer counts anything
+            RaceStat.objects.filter(count=0).delete()
+            MapMatchupStat.objects.filter(count=0).delete()
+            PlayerStat.objects.filter(games=0).delete()
+
+
+def _apply(model, key, deltas):
+    deltas = dict( (field, delta) for field, delta in deltas.items() if delta )
+    if not deltas:
+        return
+
+    updates = dict( (field, F(field) + delta) for field, delta in deltas.items() )
+    if not model.objects.filter(**key).update(**updates):
+        fields = dict(key)
+        fields.update(deltas)
+        model.objects.create(**fields)
+
+
+def update_win_rates(player_stats):
+    player_stats.filter(games__gt=0).update(win_rate=ExpressionWrapper(F('wins')*100.0/F('games'), output_field=FloatField()))
+
+
+def rebuild_summaries():
+    '''
+    Recomputes every summary table from the games, one grouped query each.
+    '''
+    RaceStat.objects.all().delete()
+    MapMatchupStat.objects.all().delete()
+    PlayerStat.objects.all().delete()
+
+    race_stats = []
+    for row in race_result_totals(GamePlayer.objects.all(), STAT_ITEMS):
+        race_stats.append( RaceStat(**row) )
+    RaceStat.objects.bulk_create(race_stats)
+
+    matchup_stats = []
+    for row in matchup_rows(Game.objects.all()):
+        matchup_stats.append( MapMatchupStat(**row) )
+    MapMatchupStat.objects.bulk_create(matchup_stats)
+
+    rows = GamePlayer.objects.values('player_id').annotate(
+        games=Count('id'),
+        wins=Sum(Case(When(result='Win', then=1), default=0, output_field=IntegerField())),
+        losses=Sum(Case(When(result='Loss', then=1), default=0, output_field=IntegerField())),
+        apm_total=Sum('apm'),
+        max_apm=Max('apm'),
+    ).order_by()
+    PlayerStat.objects.bulk_create([PlayerStat(**row) for row in rows])
+    update_win_rates(PlayerStat.objects.all())
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from zeratul.management.commands.check_query_plans import Command as CheckQueryPlans
+from zeratul.models import Map, Player, Game, GameTeam, GamePlayer
+from zeratul.stats import STAT_ITEMS
+from zeratul.summaries import rebuild_summaries
+
+
+# Each test gets a private cache it can clear, instead of the shared memcached
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+RACES = ['Zerg', 'Terran', 'Protoss']
+
+
+def create_map(name):
+    return Map.objects.create(name=name, slug=name.lower(), author='author', website='website',
+        description='description', minimap='minimaps/%s.png' % name.lower())
+
+
+def create_game(map, players_per_team, number):
+    '''
+    A finished game on map between two teams of players_per_team, with the
+    lineup columns filled in the way the importer does.
+    '''
+    game = Game.objects.create(map=map, started_at=datetime(2015, 7, 1) + timedelta(hours=number),
+        length_in_seconds=600 + number, expansion='', version='3.0.0', type='%dv%d' % (players_per_team, players_per_team),
+        region='Europe')
+
+    teams = []
+    for team_number, result in [(1, 'Win'), (2, 'Loss')]:
+        team = GameTeam.objects.create(game=game, team_number=team_number, result=result)
+        game_players = []
+        for index in range(players_per_team):
+            player, created = Player.objects.get_or_create(name='player-%d-%d' % (team_number, index),
+                defaults={'region': 'eu', 'url': '', 'highest_league': 0})
+            stats = dict( (item, 0) for item in STAT_ITEMS )
+            game_players.append( GamePlayer.objects.create(player=player, team=team, game=game, result=result,
+                color='Red', race=RACES[(number + index) % len(RACES)], handicap=100, is_human=True, apm=100, **stats) )
+        teams.append( (result, game_players) )
+
+    game.set_lineup(teams)
+    game.save()
+    return game
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryBudgetTest(TestCase):
+    '''
+    The list and detail pages must cost the same number of queries however
+    many games, teams and players they show. Budgets are for a cold cache,
+    the cost of the first request after an import.
+    '''
+
+    # Game count, last import time, ids of the page, then the games with
+    # their map, teams and players
+    GAMES_PAGE_QUERIES = 6
+    # The game with its map, teams and players, and the last import time
+    GAME_DETAIL_QUERIES = 5
+    # Map, play count and lengths, matchup stats, game ids, last import time,
+    # then the games with their map, teams and players
+    MAP_DETAIL_QUERIES = 8
+
+    def setUp(self):
+        cache.clear()
+
+    def assertPageQueries(self, count, url):
+        cache.clear()
+        with self.assertNumQueries(count):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_games_page(self):
+        map = create_map('Coda')
+        for number in range(3):
+            create_game(map, 1 + number % 3, number)
+        self.assertPageQueries(self.GAMES_PAGE_QUERIES, '/games/')
+
+        # A full page, and the one after it
+        for number in range(3, 40):
+            create_game(map, 1 + number % 3, number)
+        self.assertPageQueries(self.GAMES_PAGE_QUERIES, '/games/')
+        self.assertPageQueries(self.GAMES_PAGE_QUERIES, '/games/?page=2')
+
+    def test_game_detail(self):
+        map = create_map('Coda')
+        one_v_one = create_game(map, 1, 0)
+        four_v_four = create_game(map, 4, 1)
+        self.assertPageQueries(self.GAME_DETAIL_QUERIES, '/game/%d/' % one_v_one.id)
+        self.assertPageQueries(self.GAME_DETAIL_QUERIES, '/game/%d/' % four_v_four.id)
+
+    def test_map_detail(self):
+        small = create_map('Coda')
+        large = create_map('Echo')
+        for number in range(2):
+            create_game(small, 1, number)
+        for number in range(30):
+            create_game(large, 1 + number % 3, number)
+        self.assertPageQueries(self.MAP_DETAIL_QUERIES, '/map/coda/')
+        self.assertPageQueries(self.MAP_DETAIL_QUERIES, '/map/echo/')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class QueryPlanTest(TestCase):
+    '''
+    Every query the pages, the API and the importer send must reach the
+    game, team, player and leaderboard tables through an index. Run against
+    Postgres to check the plans production gets.
+    '''
+
+    def test_no_sequential_scans(self):
+        maps = [create_map('Coda'), create_map('Echo')]
+        for number in range(30):
+            create_game(maps[number % 2], 1 + number % 3, number)
+        rebuild_summaries()
+
+        results = CheckQueryPlans().check_plans()
+        self.assertTrue(results)
+
+        scans = [(name, sql, plan) for name, sql, plan, scanned in results if scanned]
+        self.assertEqual(scans, [])
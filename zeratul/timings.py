@@ -0,0 +1,87 @@
+import json
+import resource
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def _percentile(sorted_values, percent):
+    # Nearest rank, good enough for a performance summary
+    if not sorted_values:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _peak_rss_mb(who):
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+class ImportTimings(object):
+    '''
+    Collects how long each stage of an import takes, one sample per replay
+    (or per batch for the database writes), and summarizes them as totals and
+    p50/p95/max alongside overall throughput and peak memory.
+    '''
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.samples = defaultdict(list)
+        self.replay_count = 0
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def add_all(self, timings):
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def summary(self):
+        elapsed = time.time() - self.started_at
+
+        stages = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            stages[stage] = {
+                'count': len(samples),
+                'total': sum(samples),
+                'p50': _percentile(samples, 50),
+                'p95': _percentile(samples, 95),
+                'max': samples[-1],
+            }
+
+        return {
+            'elapsed_seconds': elapsed,
+            'replays': self.replay_count,
+            'replays_per_second': self.replay_count / elapsed if elapsed > 0 else 0.0,
+            'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF),
+            # Only covers worker processes that have already exited
+            'peak_worker_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'stages': stages,
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+
+        print '%d replays in %.1fs, %.2f replays/s, peak RSS %.1f MB (workers %.1f MB)' % (
+            summary['replays'], summary['elapsed_seconds'], summary['replays_per_second'],
+            summary['peak_rss_mb'], summary['peak_worker_rss_mb'])
+
+        print '%-12s %8s %10s %8s %8s %8s' % ('stage', 'count', 'total', 'p50', 'p95', 'max')
+        for stage, data in sorted(summary['stages'].items()):
+            print '%-12s %8d %9.1fs %7.3fs %7.3fs %7.3fs' % (
+                stage, data['count'], data['total'], data['p50'], data['p95'], data['max'])
+
+    def write_report(self, path):
+        with open(path, 'w') as report:
+            json.dump(self.summary(), report, indent=2, sort_keys=True)
@@ -16,15 +16,24 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 
-from . import views
+from . import api, views
 
 urlpatterns = [
     #url(r'^admin/', include(admin.site.urls)),
     url(r'^$', views.home, name='home'),
     url(r'^maps/$', views.maps, name='maps'),
+    url(r'^maps/matchups/$', views.map_matchups, name='map_matchups'),
     url(r'^map/(?P<slug>[\w-]+)/$', views.map_detail, name='map_detail'),
     url(r'^players/$', views.players, name='players'),
     url(r'^player/(?P<name>[\w-]+)/$', views.player_detail, name='player_detail'),
     url(r'^games/$', views.games, name='games'),
     url(r'^game/(?P<id>[0-9]+)/$', views.game_detail, name='game_detail'),
+
+    url(r'^api/games/$', api.games, name='api_games'),
+    url(r'^api/game/(?P<id>[0-9]+)/$', api.game_detail, name='api_game_detail'),
+    url(r'^api/maps/$', api.maps, name='api_maps'),
+    url(r'^api/map/(?P<slug>[\w-]+)/$', api.map_detail, name='api_map_detail'),
+    url(r'^api/players/$', api.players, name='api_players'),
+    url(r'^api/player/(?P<name>[\w-]+)/$', api.player_detail, name='api_player_detail'),
+    url(r'^api/stats/$', api.stats, name='api_stats'),
 ]
@@ -1,11 +1,41 @@
 
 from django.conf import settings
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
-from zeratul.models import Map, Game, GameTeam, GamePlayer, Player
+from zeratul.cache import get_many_by_game
+from zeratul.conditional import import_conditional
+from zeratul.models import Map, Game, GameTeam, GamePlayer, Player, PlayerStat
+from zeratul.stats import UNIT_ITEMS, RESOURCE_ITEMS, race_records, stat_matrix
 
 
-def pagination(request, object_count, per_page, display_count=10):
+def _cursor(value):
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def game_rows(ids, template_name):
+    '''
+    The games with ids rendered with template_name, one row each. Rows are
+    cached per game, so a page takes one multi-get and only rows rendered
+    for the first time need their game summaries.
+    '''
+    def render_rows(missing):
+        games = Game.objects.get_game_summaries(missing)
+        return dict( (game['id'], render_to_string(template_name, {'game': game})) for game in games )
+    return [mark_safe(row) for row in get_many_by_game('row:' + template_name, ids, render_rows)]
+
+
+def pagination(request, object_count, per_page, display_count=10, cursors=None):
+    '''
+    Page links and counts for a list. By default pages are numbered and the
+    caller slices with data_start/data_end. When cursors, the after/before
+    ids returned by a keyset query, are given the Prev and Next links seek
+    from them instead, and the page number only tracks the position.
+    '''
     page_data = {}
     try:
         page = int(request.GET.get('page', '1'))
@@ -37,15 +67,26 @@ def pagination(request, object_count, per_page, display_count=10):
     page_data['page_last'] = page-1
     page_data['page_next'] = page+1
 
+    page_data['has_prev'] = page > 1
+    page_data['has_next'] = page < page_count
+    page_data['page_after'] = None
+    page_data['page_before'] = None
+    if cursors is not None:
+        page_data['has_prev'] = cursors['before'] is not None
+        page_data['has_next'] = cursors['after'] is not None
+        page_data['page_after'] = cursors['after']
+        page_data['page_before'] = cursors['before']
+
     return page_data
 
 
+@import_conditional
 def home(request):
     context = {}
 
-    context['player_count'] = Player.objects.count()
-    context['map_count'] = Map.objects.count()
-    context['game_count'] = Game.objects.count()
+    context['player_count'] = Player.objects.cached_count()
+    context['map_count'] = len(Map.objects.get_all())
+    context['game_count'] = Game.objects.cached_count()
     context['avg_game_length'] = Game.objects.average_game_length()
 
     context['total_time'] = Game.objects.total_gameplay_time()
@@ -54,48 +95,16 @@ def home(request):
     context['avg_of_best_apm'] = Player.objects.average_of_best_apms()
 
 
-    # TODO: Move the majority of the following logic to models
-    unit_list = ['army_killed', 'army_created', 'army_lost',
-            'buildings_created', 'buildings_lost', 'buildings_killed',
-            'workers_created', 'workers_lost', 'workers_killed']
-
-    resource_list = ['minerals_spent', 'minerals_lost', 'vespene_spent', 'vespene_lost']
-
-    for race in ['Zerg', 'Protoss', 'Terran']:
-        context[race] = {
-            'wins': Game.objects.num_1v1_wins(race),
-            'games': Game.objects.number_of_games_with(race),
-        }
-        context[race]['win_rate'] = float(context[race]['wins'])/float(context[race]['games'])*100.0
+    # Every number below comes from the per race and result summary rows
+    totals = Game.objects.race_result_totals()
 
+    context.update( race_records(totals, ['Zerg', 'Protoss', 'Terran']) )
 
     units_header = ['Units', 'Total', 'Average', 'Zerg', 'Z (avg)', 'Z Win (avg)', 'Z Loss (avg)', 'Terran', 'T (avg)', 'T Win (avg)', 'T Loss (avg)', 'Protoss', 'P (avg)', 'P Win (avg)', 'P Loss (avg)']
-    units = []
-    for item in unit_list:
-        cur_item = [item]
-        cur_item.append( Game.objects.total_generic(item) )
-        cur_item.append( Game.objects.average_generic(item) )
-
-        for race in ['Zerg', 'Terran', 'Protoss']:
-            cur_item.append( Game.objects.total_generic_by_race(race, item) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item, result=True) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item, result=False) )
-        units.append( cur_item)
+    units = stat_matrix(totals, UNIT_ITEMS, ['Zerg', 'Terran', 'Protoss'])
 
     resources_header = ['Resources', 'Total', 'Average', 'Zerg', 'Z (avg)', 'Z Win (avg)', 'Z Loss (avg)', 'Terran', 'T (avg)', 'T Win (avg)', 'T Loss (avg)', 'Protoss', 'P (avg)', 'P Win (avg)', 'P Loss (avg)']
-    resources = []
-    for item in resource_list:
-        cur_item = [item]
-        cur_item.append( Game.objects.total_generic(item) )
-        cur_item.append( Game.objects.average_generic(item) )
-
-        for race in ['Zerg', 'Terran', 'Protoss']:
-            cur_item.append( Game.objects.total_generic_by_race(race, item) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item, result=True) )
-            cur_item.append( Game.objects.average_generic_by_race(race, item, result=False) )
-        resources.append( cur_item )
+    resources = stat_matrix(totals, RESOURCE_ITEMS, ['Zerg', 'Terran', 'Protoss'])
 
     context['units_header'] = units_header
     context['units'] = units
@@ -104,47 +113,65 @@ def home(request):
     context['resources'] = resources
     # Min, Max and Average APM?
 
+    race_stats = Game.objects.race_stats()
+
     context['matches'] = {
-        'ZvZ': Game.objects.get_mirror_match_count('Zerg'),
-        'PvP': Game.objects.get_mirror_match_count('Protoss'),
-        'TvT': Game.objects.get_mirror_match_count('Terran'),
-        'ZvT': Game.objects.get_match_count('Zerg', 'Terran'),
-        'ZvP': Game.objects.get_match_count('Zerg', 'Protoss'),
-        'TvP': Game.objects.get_match_count('Terran', 'Protoss'),
+        'ZvZ': race_stats['ZvZ']['Count'],
+        'PvP': race_stats['PvP']['Count'],
+        'TvT': race_stats['TvT']['Count'],
+        'ZvT': race_stats['ZvT']['Count'],
+        'ZvP': race_stats['ZvP']['Count'],
+        'TvP': race_stats['TvP']['Count'],
     }
 
     context['win_ratios'] = {
-        'zvt_z': Game.objects.get_match_win_count('Zerg', 'Terran'),
-        'zvt_t': Game.objects.get_match_win_count('Terran', 'Zerg'),
-        'zvp_z': Game.objects.get_match_win_count('Zerg', 'Protoss'),
-        'zvp_p': Game.objects.get_match_win_count('Protoss', 'Zerg'),
-        'tvp_t': Game.objects.get_match_win_count('Terran', 'Protoss'),
-        'tvp_p': Game.objects.get_match_win_count('Protoss', 'Terran'),
+        'zvt_z': race_stats['ZvT']['Zerg'],
+        'zvt_t': race_stats['ZvT']['Terran'],
+        'zvp_z': race_stats['ZvP']['Zerg'],
+        'zvp_p': race_stats['ZvP']['Protoss'],
+        'tvp_t': race_stats['TvP']['Terran'],
+        'tvp_p': race_stats['TvP']['Protoss'],
+
+        'zvt_z_per': race_stats['ZvT']['percent_zerg'],
+        'zvt_t_per': race_stats['ZvT']['percent_terran'],
+        'zvp_z_per': race_stats['ZvP']['percent_zerg'],
+        'zvp_p_per': race_stats['ZvP']['percent_protoss'],
+        'tvp_t_per': race_stats['TvP']['percent_terran'],
+        'tvp_p_per': race_stats['TvP']['percent_protoss'],
     }
 
-    context['win_ratios']['zvt_z_per'] = float(context['win_ratios']['zvt_z'])/float(context['matches']['ZvT'])*100.0
-    context['win_ratios']['zvt_t_per'] = float(context['win_ratios']['zvt_t'])/float(context['matches']['ZvT'])*100.0
-    context['win_ratios']['zvp_z_per'] = float(context['win_ratios']['zvp_z'])/float(context['matches']['ZvP'])*100.0
-    context['win_ratios']['zvp_p_per'] = float(context['win_ratios']['zvp_p'])/float(context['matches']['ZvP'])*100.0
-    context['win_ratios']['tvp_t_per'] = float(context['win_ratios']['tvp_t'])/float(context['matches']['TvP'])*100.0
-    context['win_ratios']['tvp_p_per'] = float(context['win_ratios']['tvp_p'])/float(context['matches']['TvP'])*100.0
-
     context['dashboard_active'] = True
     return render(request, 'home.html', context)
 
 #
 # Players
 #
+@import_conditional
 def players(request):
     context = {}
+    per_page = 50
+
+    sort = request.GET.get('sort')
+    if sort not in PlayerStat.SORT_FIELDS:
+        sort = 'games'
+
+    page = Player.objects.get_leaderboard_page(sort, per_page, after=_cursor(request.GET.get('after')), before=_cursor(request.GET.get('before')))
+    context.update( pagination(request, per_page=per_page, object_count=Player.objects.cached_count(), cursors=page) )
+    context['players'] = page['players']
+    context['sort'] = sort
 
     context['players_active'] = True
     return render(request, 'players.html', context)
 
 
+@import_conditional
 def player_detail(request, name):
     context = {}
 
+    context['player'] = Player.objects.get_player_profile(name)
+    if context['player'] is None:
+        return redirect('players')
+
     context['players_active'] = True
     return render(request, 'player_detail.html', context)
 
@@ -152,40 +179,63 @@ def player_detail(request, name):
 #
 # Maps
 #
+@import_conditional
 def maps(request):
     context = {}
 
-    context['map_count'] = Map.objects.count()
     context['maps'] = Map.objects.get_all()
+    context['map_count'] = len(context['maps'])
 
     context['maps_active'] = True
     return render(request, 'maps.html', context)
 
 
+@import_conditional
 def map_detail(request, slug):
     context = {}
 
-    if not Map.objects.filter(slug=slug).exists():
-        return redirect('maps')
-
     context['map'] = Map.objects.get_all_map_details(slug)
+    if not context['map']:
+        return redirect('maps')
+    context['games'] = game_rows(context['map']['game_ids'], 'map_detail_row.html')
 
     context['maps_active'] = True
     return render(request, 'map_detail.html', context)
 
+
+@import_conditional
+def map_matchups(request):
+    context = {}
+
+    context['maps'] = Map.objects.get_matchup_matrix()
+
+    context['maps_active'] = True
+    return render(request, 'map_matchups.html', context)
+
 #
 # Games
 #
+@import_conditional
 def games(request):
     context = {}
-
-    context.update( pagination(request, per_page=25, object_count=Game.objects.count()) )
-
-    context['games'] = Game.objects.get_paged_game_summaries(context['data_start'], context['data_end'])
+    per_page = 25
+
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if request.GET.get('page') and not (after or before):
+        # Jumping straight to a numbered page still needs an OFFSET
+        context.update( pagination(request, per_page=per_page, object_count=Game.objects.cached_count()) )
+        ids = Game.objects.get_paged_game_ids(context['data_start'], context['data_end'])
+    else:
+        page = Game.objects.get_game_ids_page(per_page, after=_cursor(after), before=_cursor(before))
+        context.update( pagination(request, per_page=per_page, object_count=Game.objects.cached_count(), cursors=page) )
+        ids = page['ids']
+    context['games'] = game_rows(ids, 'games_row.html')
 
     context['games_active'] = True
     return render(request, 'games.html', context)
 
+@import_conditional
 def game_detail(request, id):
     context = {}
 